@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+# the benchmark imports the generator from the root of the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+# sizes of the synthetic templates and vocabularies for each preset
+presets = {
+    "small": {"rows": 20, "name1_options": 2, "name2_options": 2, "lex_div_words": 1, "lex_div_options": 2, "proper_names": 6, "proper_name_rows": 0.1},
+    "medium": {"rows": 40, "name1_options": 3, "name2_options": 3, "lex_div_words": 2, "lex_div_options": 2, "proper_names": 8, "proper_name_rows": 0.1},
+    "large": {"rows": 100, "name1_options": 4, "name2_options": 4, "lex_div_words": 2, "lex_div_options": 3, "proper_names": 12, "proper_name_rows": 0.1},
+}
+
+# category of the synthetic templates (SES, because it's the one that can use both the names column and proper names)
+synthetic_category = "SES"
+
+def build_synthetic_vocabulary(config: dict) -> pd.DataFrame:
+    """
+    Builds a vocabulary spreadsheet (in the format of `templates/vocabulary.xlsx`) with the names used in the synthetic templates, so that their feminine forms are looked up like in the real templates.
+    """
+    names = [f"nombre{i}" for i in range(max(config["name1_options"], config["name2_options"]) * 2)]
+    return pd.DataFrame({
+        "category": synthetic_category,
+        "subcategory": "",
+        "name_es": names,
+        "name_ca": names,
+        "name_def_ca": [f"el {name}" for name in names],
+        "f_es": [f"{name}a" for name in names],
+        "f_ca": [f"{name}a" for name in names],
+        "f_def_ca": [f"la {name}a" for name in names],
+        "information": "",
+        "include_name": "",
+        "esbbq_source": "",
+    })
+
+def build_synthetic_proper_names(config: dict) -> pd.DataFrame:
+    """
+    Builds a proper names spreadsheet (in the format of `templates/vocabulary_proper_names.xlsx`) with `proper_names` names of alternating gender.
+    """
+    names = [f"Nombre{i}" for i in range(config["proper_names"])]
+    genders = ["f" if i % 2 else "m" for i in range(config["proper_names"])]
+    return pd.DataFrame({
+        "proper_name_es": names,
+        "proper_name_ca": names,
+        "proper_name_def_ca": [f"{'la' if gender == 'f' else 'el'} {name}" for name, gender in zip(names, genders)],
+        "gender": genders,
+        "ethnicity_es": "blanco",
+        "ethnicity_ca": "blanc",
+        "esbbq_source": "",
+        "cabbq_source": "",
+    })
+
+def build_synthetic_templates(config: dict) -> pd.DataFrame:
+    """
+    Builds a category spreadsheet with `rows` template rows in both languages.
+    Each row uses NAME1 and NAME2 in both contexts and `lex_div_words` WORD variables with `lex_div_options` options each, and a fraction `proper_name_rows` of the rows uses proper names.
+    The Catalan texts use the -def specifiers and contexts like "a el" and "de <vowel>" that trigger the linguistic replacements.
+    """
+    words = [f"WORD{k + 1}" for k in range(config["lex_div_words"])]
+    word_slots = " ".join(f"{{{{{word}}}}}" for word in words)
+    lex_div_es = "; ".join(f"{word}: [{', '.join(f'objeto{k}_{j}' for j in range(config['lex_div_options']))}]" for k, word in enumerate(words))
+    lex_div_ca = "; ".join(f"{word}: [{', '.join(f'objecte{k}_{j}' for j in range(config['lex_div_options']))}]" for k, word in enumerate(words))
+
+    num_proper_name_rows = round(config["rows"] * config["proper_name_rows"])
+
+    rows = []
+    for row_idx in range(config["rows"]):
+        proper_names_only = row_idx < num_proper_name_rows
+
+        if proper_names_only:
+            names_es = names_ca = ""
+            name1_ca, name2_ca = "{{NAME1}}", "{{NAME2}}"
+        else:
+            name1_options = [f"nombre{i}" for i in range(config["name1_options"])]
+            name2_options = [f"nombre{config['name1_options'] + i}" for i in range(config["name2_options"])]
+            names_es = f"NAME1: [{', '.join(name1_options)}]; NAME2: [{', '.join(name2_options)}]"
+            names_ca = f"{names_es}; NAME1-def: [{', '.join(f'el {name}' for name in name1_options)}]; NAME2-def: [{', '.join(f'el {name}' for name in name2_options)}]"
+            name1_ca, name2_ca = "{{NAME1-def}}", "{{NAME2-def}}"
+
+        rows.append({
+            "label": "t",
+            "bbq_template_id": row_idx // 2,
+            "esbbq_template_id": row_idx // 2,
+            "version": "ab"[row_idx % 2],
+            "bbq_category": synthetic_category,
+            "esbbq_category": synthetic_category,
+            "subcategory": "",
+            "ambiguous_context_es": f"ayer {{{{NAME1}}}} y {{{{NAME2}}}} fueron a el mercado a comprar {word_slots}. no se sabe nada más",
+            "ambiguous_context_ca": f"ahir {name1_ca} i {name2_ca} van anar a el mercat a comprar {word_slots}. no se'n sap res més",
+            "disambiguating_context_es": "{{NAME1}} no pudo pagar. {{NAME2}} pagó todo.",
+            "disambiguating_context_ca": f"{name1_ca} no va poder pagar. {name2_ca} ho va pagar tot de amagat.",
+            "names_es": names_es,
+            "names_ca": names_ca,
+            "lexical_diversity_es": lex_div_es,
+            "lexical_diversity_ca": lex_div_ca,
+            "question_negative_stereotype_es": "¿Quién no pudo pagar?",
+            "question_negative_stereotype_ca": "Qui no va poder pagar?",
+            "question_non_negative_es": "¿Quién pagó todo?",
+            "question_non_negative_ca": "Qui ho va pagar tot?",
+            "answer_negative_es": "{{NAME1}}",
+            "answer_negative_ca": name1_ca,
+            "answer_non_negative_es": "{{NAME2}}",
+            "answer_non_negative_ca": name2_ca,
+            "relevant_social_values_es": "pobreza",
+            "relevant_social_values_ca": "pobresa",
+            "stereotyped_groups": '["lowSES"]',
+            "proper_nouns_only": 1 if proper_names_only else "",
+            "NAME1_info": "lowSES",
+            "NAME2_info": "highSES",
+            "stated_gender_info": "f" if row_idx % 3 == 0 else "m",
+            "esbbq_source": '["https://example.org"]',
+        })
+
+    return pd.DataFrame(rows)
+
+def write_synthetic_spreadsheets(config: dict, output_dir: str) -> None:
+    """
+    Saves the synthetic spreadsheets under `<output_dir>/templates`, with the same file names that the generator expects.
+    """
+    os.makedirs(os.path.join(output_dir, "templates"), exist_ok=True)
+    build_synthetic_vocabulary(config).to_excel(os.path.join(output_dir, "templates", "vocabulary.xlsx"), index=False)
+    build_synthetic_proper_names(config).to_excel(os.path.join(output_dir, "templates", "vocabulary_proper_names.xlsx"), index=False)
+    build_synthetic_templates(config).to_excel(os.path.join(output_dir, "templates", f"{synthetic_category}.xlsx"), sheet_name="Sheet1", index=False)
+
+def run_benchmark(config: dict, lang: str, output_formats: list[str]) -> dict:
+    """
+    Runs the stages of the generation of the synthetic category once, in the working directory where the synthetic spreadsheets were saved, and times each of them separately.
+
+    Returns:
+        dict: The time (in seconds) of each stage and the number of instances generated.
+    """
+    from generate_instances import (
+        build_arg_parser,
+        deduplicate_instances,
+        generate_category_instances,
+        read_category_spreadsheet,
+        read_proper_names_spreadsheet,
+        read_spreadsheet_cached,
+        read_vocabulary_spreadsheet,
+    )
+    from instance_writers import instance_writers
+    from profiling import Profiler
+    from utils import TemplateRow, capitalize_sents, get_all_permutations
+
+    # start every run with cold caches, as a new generation would
+    capitalize_sents.cache_clear()
+
+    times = {}
+    # the default options of the CLI, so that the benchmark keeps up with the options that the generation reads
+    args = build_arg_parser().parse_args(["--language", lang])
+
+    start = time.perf_counter()
+    df_vocab = read_spreadsheet_cached("templates/vocabulary.xlsx", [lang], read_vocabulary_spreadsheet, use_cache=False)[lang]
+    df_proper_names = read_spreadsheet_cached("templates/vocabulary_proper_names.xlsx", [lang], read_proper_names_spreadsheet, use_cache=False)[lang]
+    df_category = read_spreadsheet_cached(f"templates/{synthetic_category}.xlsx", [lang], read_category_spreadsheet, use_cache=False)[lang]
+    times["load"] = time.perf_counter() - start
+
+    template_rows = [(row_idx, TemplateRow.from_dict(row)) for row_idx, row in zip(df_category.index, df_category.to_dict("records"))]
+
+    start = time.perf_counter()
+    template_rows, _ = get_all_permutations(template_rows)
+    times["permutation"] = time.perf_counter() - start
+
+    # the filling and the assembly of the instances are interleaved, so they are timed with the profiler of the generator (without tracing memory)
+    profiler = Profiler(enabled=True, trace_memory=False)
+    start = time.perf_counter()
+    instances = [(row_idx, {lang: instance}) for row_idx, instance in generate_category_instances(synthetic_category, template_rows, lang, df_vocab, df_proper_names, args, {}, profiler)]
+    times["generation"] = time.perf_counter() - start
+    times["fill"] = profiler.stage_times["fill"]
+    times["assembly"] = profiler.stage_times["assembly"]
+
+    start = time.perf_counter()
+    instances = [{"instance_id": instance_id, **aligned_instances[lang]} for instance_id, (_, aligned_instances) in enumerate(deduplicate_instances(instances, Profiler()))]
+    times["dedup"] = time.perf_counter() - start
+
+    for output_format in output_formats:
+        start = time.perf_counter()
+        with instance_writers[output_format](f"instances.{output_format}") as writer:
+            for instance in instances:
+                writer.write(instance)
+        times[f"write_{output_format}"] = time.perf_counter() - start
+
+    return {"times": times, "instances": len(instances)}
+
+def summarize_runs(runs: list[dict]) -> dict:
+    """
+    Summarizes the repeated runs of a benchmark with the best and median time of each stage, and the throughput (instances/sec) of the best time.
+    """
+    num_instances = runs[0]["instances"]
+    summary = {"instances": num_instances, "stages": {}}
+    for stage in runs[0]["times"]:
+        stage_times = [run["times"][stage] for run in runs]
+        summary["stages"][stage] = {
+            "best_s": round(min(stage_times), 5),
+            "median_s": round(statistics.median(stage_times), 5),
+            "instances_per_s": round(num_instances / min(stage_times)) if min(stage_times) else None,
+        }
+    return summary
+
+# commands whose wall time is measured to check the startup of the scripts, run from the root of the repository (see `measure_startup`)
+startup_commands = {
+    "import_generate_instances": [sys.executable, "-c", "import generate_instances"],
+    "generate_instances_help": [sys.executable, "generate_instances.py", "--help"],
+    "import_bias_score": [sys.executable, "-c", "import bias_score"],
+}
+
+# slow modules that should only be imported on the code paths that need them, not just by importing the generator
+deferred_modules = ["pandas", "nltk", "tabulate", "pyarrow"]
+
+def measure_startup(repeats: int) -> dict:
+    """
+    Measures the startup time of the scripts, running each command of `startup_commands` on a new interpreter (so that nothing is imported beforehand), and checks which of the `deferred_modules` are imported just by importing the generator.
+
+    Returns:
+        dict: The best and median wall time (in seconds) of each command, and the deferred modules imported by the generator.
+    """
+    startup = {"commands": {}}
+    for command_name, command in startup_commands.items():
+        command_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=repo_dir, check=True, stdout=subprocess.DEVNULL)
+            command_times.append(time.perf_counter() - start)
+        startup["commands"][command_name] = {"best_s": round(min(command_times), 4), "median_s": round(statistics.median(command_times), 4)}
+
+    check_modules = f"import sys, generate_instances; print(','.join(module for module in {deferred_modules!r} if module in sys.modules))"
+    imported_modules = subprocess.run([sys.executable, "-c", check_modules], cwd=repo_dir, check=True, capture_output=True, text=True).stdout.strip()
+    startup["deferred_modules_imported"] = imported_modules.split(",") if imported_modules else []
+
+    return startup
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Benchmark EsBBQ Generation", description="Generates synthetic templates and vocabularies of controllable size and times each stage of the generation of their instances (loading, permutations, filling, assembly, deduplication and writers). It also measures the startup time of the scripts.")
+    parser.add_argument("--presets", nargs="+", choices=presets, default=["small", "medium"], help="Space-separated presets of sizes to benchmark. The options below override the sizes of all the presets.")
+    parser.add_argument("--rows", type=int, help="Number of template rows.")
+    parser.add_argument("--name1-options", type=int, help="Number of options for NAME1 in the names column.")
+    parser.add_argument("--name2-options", type=int, help="Number of options for NAME2 in the names column.")
+    parser.add_argument("--lex-div-words", type=int, help="Number of WORD variables of lexical diversity in each template.")
+    parser.add_argument("--lex-div-options", type=int, help="Number of options for each WORD variable.")
+    parser.add_argument("--proper-names", type=int, help="Number of proper names in the vocabulary.")
+    parser.add_argument("--proper-name-rows", type=float, help="Fraction of the template rows that use proper names.")
+    parser.add_argument("--languages", nargs="+", choices=["es", "ca"], default=["es", "ca"], help="Space-separated languages to benchmark (Catalan also exercises the handling of articles).")
+    parser.add_argument("--output-formats", nargs="+", choices=["jsonl", "csv", "parquet"], default=["jsonl", "csv"], help="Space-separated writers to benchmark.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of times each benchmark is run (the best and median times are reported).")
+    parser.add_argument("--max-import-s", type=float, help="Fail (with exit code 1) if importing the generator takes longer than this many seconds, or imports any of the slow modules that it should only import when needed, to catch startup regressions in CI.")
+    parser.add_argument("--output", default=os.path.join(repo_dir, ".cache", "benchmarks", "results.json"), help="JSON file where the results are saved. By default, it's saved in the cache folder of the repository, which is ignored by git.")
+
+    args = parser.parse_args()
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pandas": pd.__version__,
+        },
+        "benchmarks": [],
+    }
+
+    # startup of the scripts, before any benchmark imports the generator in this process
+    results["startup"] = measure_startup(args.repeats)
+    for command_name, command_summary in results["startup"]["commands"].items():
+        print(f"[startup] {command_name:<26} {command_summary['best_s']:>9.4f}s")
+    print(f"[startup] slow modules imported by the generator: {', '.join(results['startup']['deferred_modules_imported']) or 'none'}")
+
+    for preset in args.presets:
+        # apply the sizes passed as arguments on top of the preset
+        config = {**presets[preset], **{key: value for key, value in vars(args).items() if key in presets[preset] and value is not None}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_synthetic_spreadsheets(config, tmp_dir)
+
+            # the generator reads the templates relative to the working directory
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                for lang in args.languages:
+                    runs = [run_benchmark(config, lang, args.output_formats) for _ in range(args.repeats)]
+                    summary = summarize_runs(runs)
+                    results["benchmarks"].append({"preset": preset, "language": lang, "config": config, **summary})
+
+                    print(f"[{preset}/{lang}] {summary['instances']} instances")
+                    for stage, stage_summary in summary["stages"].items():
+                        print(f"[{preset}/{lang}] {stage:<12} {stage_summary['best_s']:>9.4f}s  {stage_summary['instances_per_s'] or '-':>10} instances/s")
+            finally:
+                os.chdir(cwd)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Results saved to `{args.output}`.")
+
+    if args.max_import_s is not None:
+        import_time = results["startup"]["commands"]["import_generate_instances"]["best_s"]
+        if import_time > args.max_import_s or results["startup"]["deferred_modules_imported"]:
+            print(f"Startup regression: importing the generator takes {import_time}s (max: {args.max_import_s}s) and imports: {', '.join(results['startup']['deferred_modules_imported']) or 'none'}.")
+            sys.exit(1)
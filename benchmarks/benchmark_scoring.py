@@ -0,0 +1,123 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+# the benchmark imports the scorer from the root of the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from bias_score import StreamingScorer, get_doc_arrays, get_scores, get_scores_vectorized
+
+# number of multiple-choice options of each instance in the evaluation harness (ans0, ans1 and the different wordings of "unknown")
+num_options = 11
+
+def read_docs(lang: str) -> list[dict]:
+    """
+    Reads the instances of all the categories of a language from the JSONL files in `data_<lang>`, to use them as the docs of the synthetic results.
+    """
+    docs = []
+    for input_fn in sorted(glob.glob(os.path.join(repo_dir, f"data_{lang}", "*.full.jsonl"))):
+        with open(input_fn) as f:
+            docs.extend(json.loads(line) for line in f)
+    return docs
+
+def build_synthetic_results(docs: list[dict], seed: int) -> list[dict]:
+    """
+    Builds synthetic results of a model in the format of the samples saved by the evaluation harness, with random loglikelihoods for the options of each doc.
+    Loglikelihoods are rounded so that some options are tied, and saved as strings like in the harness.
+    """
+    rng = np.random.default_rng(seed)
+    lls = np.round(rng.normal(-10, 2, size=(len(docs), num_options)), 1)
+    return [{"doc": doc, "filtered_resps": [[str(ll), "False"] for ll in instance_lls]} for doc, instance_lls in zip(docs, lls.tolist())]
+
+def score_streaming(harness_results: list[dict]) -> dict:
+    """
+    Scores the results one instance at a time with `StreamingScorer`, like when reading them from the sample files.
+    """
+    scorer = StreamingScorer()
+    for instance in harness_results:
+        scorer.update(instance)
+    return scorer.get_scores()
+
+def time_scorer(scorer, harness_results: list[dict], repeats: int) -> dict:
+    """
+    Runs a scorer on the results `repeats` times and returns its scores and the best and median times.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        scores = scorer(harness_results)
+        times.append(time.perf_counter() - start)
+    return {"scores": scores, "best_s": round(min(times), 4), "median_s": round(statistics.median(times), 4)}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark of the scoring functions of `bias_score.py` on synthetic results of several models (checkpoints) over the instances in `data_<language>`, checking that all of them return the same scores.")
+    parser.add_argument("--languages", nargs="+", choices=["es", "ca"], default=["es", "ca"], help="Space-separated languages whose instances are scored.")
+    parser.add_argument("--checkpoints", type=int, default=3, help="Number of synthetic models whose results are scored on each language.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of times each scorer is run on each checkpoint (the best and median times are reported).")
+    parser.add_argument("--output", default=os.path.join(repo_dir, ".cache", "benchmarks", "scoring_results.json"), help="JSON file where the results are saved. By default, it's saved in the cache folder of the repository, which is ignored by git.")
+
+    args = parser.parse_args()
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+        },
+        "benchmarks": [],
+    }
+
+    mismatches = 0
+    for lang in args.languages:
+        docs = read_docs(lang)
+
+        # the arrays of the docs are shared by all the checkpoints, like when scoring a sweep
+        start = time.perf_counter()
+        doc_arrays = get_doc_arrays(docs)
+        doc_arrays_s = round(time.perf_counter() - start, 4)
+        print(f"[{lang}] {len(docs)} instances, doc arrays extracted in {doc_arrays_s}s")
+
+        for checkpoint in range(args.checkpoints):
+            harness_results = build_synthetic_results(docs, seed=checkpoint)
+
+            scorers = {
+                "get_scores": get_scores,
+                "get_scores_vectorized": lambda harness_results: get_scores_vectorized(harness_results, doc_arrays),
+                "StreamingScorer": score_streaming,
+            }
+            timings = {scorer_name: time_scorer(scorer, harness_results, args.repeats) for scorer_name, scorer in scorers.items()}
+
+            reference_scores = timings["get_scores"]["scores"]
+            for scorer_name, timing in timings.items():
+                # scores must be exactly the same, not just close
+                if timing["scores"] != reference_scores:
+                    mismatches += 1
+                    print(f"[{lang}/{checkpoint}] {scorer_name} returned different scores: {timing['scores']} != {reference_scores}")
+                print(f"[{lang}/{checkpoint}] {scorer_name:<22} {timing['best_s']:>9.4f}s")
+
+            results["benchmarks"].append({
+                "language": lang,
+                "checkpoint": checkpoint,
+                "instances": len(docs),
+                "doc_arrays_s": doc_arrays_s,
+                "scores": reference_scores,
+                "timings": {scorer_name: {"best_s": timing["best_s"], "median_s": timing["median_s"]} for scorer_name, timing in timings.items()},
+            })
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Results saved to `{args.output}`.")
+
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,56 @@
+import argparse
+import filecmp
+import glob
+import os
+import sys
+import tempfile
+
+# the check imports the generator from the root of the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from generate_instances import Generator
+
+def get_committed_fns(lang: str, categories: list[str], output_formats: list[str]) -> list[str]:
+    """
+    Returns the committed output files of a language (in `data_<lang>`) of the given categories and formats, relative to the root of the repository.
+    """
+    committed_fns = []
+    for output_format in output_formats:
+        for output_fn in sorted(glob.glob(os.path.join(repo_dir, f"data_{lang}", f"*.full.{output_format}"))):
+            if os.path.basename(output_fn).split(".")[0] in categories:
+                committed_fns.append(os.path.relpath(output_fn, repo_dir))
+    return committed_fns
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Regenerates the datasets of each language to a temporary folder and checks that they are byte-identical to the files committed in `data_<language>` (only the formats and categories that are committed are compared). Exits with an error if any file differs.")
+    parser.add_argument("--languages", nargs="+", choices=["es", "ca"], default=["es", "ca"], help="Space-separated languages to check. Each one is generated on its own, like the committed datasets.")
+    parser.add_argument("--categories", nargs="+", help="Space-separated categories to check. If not passed, all of them are checked.")
+    parser.add_argument("--output-formats", nargs="+", choices=["jsonl", "csv"], default=["jsonl", "csv"], help="Space-separated formats to check.")
+
+    args = parser.parse_args()
+
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for lang in args.languages:
+            generator = Generator([lang], templates_dir=os.path.join(repo_dir, "templates"), output_dir=tmp_dir, cache_dir=os.path.join(tmp_dir, ".cache"), categories=args.categories, output_formats=args.output_formats)
+            committed_fns = get_committed_fns(lang, generator.categories, args.output_formats)
+            generator.generate_categories(list(dict.fromkeys(os.path.basename(committed_fn).split(".")[0] for committed_fn in committed_fns)))
+
+            for committed_fn in committed_fns:
+                generated_fn = os.path.join(tmp_dir, committed_fn)
+                if not os.path.exists(generated_fn):
+                    status = "missing"
+                elif filecmp.cmp(generated_fn, os.path.join(repo_dir, committed_fn), shallow=False):
+                    status = "identical"
+                else:
+                    status = "DIFFERENT"
+
+                mismatches += status != "identical"
+                print(f"[{lang}] {committed_fn:<45} {status}")
+
+    print(f"{mismatches} committed files differ from the regenerated ones.")
+
+    if mismatches:
+        sys.exit(1)
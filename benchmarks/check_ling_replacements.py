@@ -0,0 +1,127 @@
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+
+# the check imports the replacements from the root of the repository
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from utils import get_ling_rewriter
+
+# columns of the datasets whose texts are rewritten by the replacements when the instances are generated
+text_columns = ["context", "question", "ans0", "ans1", "ans2"]
+
+# contractions made by the replacements, undone to get texts where the rules have something to rewrite (in the committed datasets they have already been applied)
+undo_contractions = [
+    (r"\bdel(s?)\b", r"de el\1"),
+    (r"\b([aA])l(s?)\b", r"\1 el\2"),
+    (r"\bd'", r"de "),
+    (r"que (es|és) (testigo de Jehová|testimoni de Jehovà)", r"\2"),
+]
+
+# frozen copy of the linguistic replacements as they were before they were compiled into stages (see `utils.ling_replacements`), applied one after the other with `re.sub`
+# this is the reference behavior, so that a wrong edit of the current rules is caught instead of being compared against itself
+baseline_ling_replacements = {
+    'es': [
+        (r"\bde el\b", "del"),
+        (r"\b([aA]) el\b", r"\1l"),
+        ("testigo de Jehová", "que es testigo de Jehová"),
+    ],
+    'ca': [
+        (r"\bde el(s?)\b", r"del\1"),
+        (r"\b([aA]) el(s?)\b", r"\1l\2"),
+        (r"\bde ([aAeEèÈéÉiIoOòÒóÓuUhH])", r"d'\1"),
+        (r"\bd'io", r"de io"),
+        ("testimoni de Jehovà", "que és testimoni de Jehovà"),
+    ],
+}
+
+# texts rewritten by each rule, and texts where a rule rewrites the output of another one (or where the matches of two rules overlap), which a single regex pass would not handle like applying the rules one after the other, with the text they must be rewritten as
+adversarial_texts = {
+    'es': [
+        ("Vino de el pueblo", "Vino del pueblo"),
+        ("Se lo dio a el niño", "Se lo dio al niño"),
+        ("Habla de a el niño", "Habla de al niño"),
+        ("Se lo dio a el de el barrio", "Se lo dio al del barrio"),
+        ("A el de el testigo de Jehová", "Al del que es testigo de Jehová"),
+        ("de de el a a el", "de del a al"),
+    ],
+    'ca': [
+        ("Ve de el poble", "Ve del poble"),
+        ("Parla de una amiga", "Parla d'una amiga"),
+        ("Parla de Hug", "Parla d'Hug"),
+        ("Parla de a el nen", "Parla d'al nen"),
+        ("Parla de a els nens", "Parla d'als nens"),
+        ("Parla de A el nen", "Parla d'Al nen"),
+        ("de el a el de els a els", "del al dels als"),
+        ("Ho va dir de el de a els", "Ho va dir del d'als"),
+        ("Va parlar de io-io i d'ioga", "Va parlar de io-io i de ioga"),
+        ("de de a el testimoni de Jehovà", "de d'al que és testimoni de Jehovà"),
+    ],
+}
+
+def read_texts(lang: str) -> tuple[list[str], list[str]]:
+    """
+    Reads the texts of all the instances of a language from the CSV files in `data_<lang>`, both as committed and with the contractions undone (only the ones that change).
+    """
+    texts = set()
+    for input_fn in sorted(glob.glob(os.path.join(repo_dir, f"data_{lang}", "*.full.csv"))):
+        with open(input_fn, newline="") as f:
+            for row in csv.DictReader(f):
+                texts.update(row[column] for column in text_columns)
+
+    undone_texts = set()
+    for text in texts:
+        undone_text = text
+        for pattern, replacement in undo_contractions:
+            undone_text = re.sub(pattern, replacement, undone_text)
+        undone_texts.add(undone_text)
+
+    return sorted(texts), sorted(undone_texts - texts)
+
+def apply_baseline(lang: str, text: str) -> str:
+    """
+    Applies the baseline replacements of a language one rule after the other with `re.sub`, which is the behavior the compiled rewriter must match.
+    """
+    for pattern, replacement in baseline_ling_replacements[lang]:
+        text = re.sub(pattern, replacement, text)
+    return text
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Checks that the compiled linguistic replacements of `utils.py` (one regex pass per stage) rewrite the texts in `data_<language>` (as committed and with the contractions undone) exactly like the baseline rules applied one after the other, and that the adversarial texts are rewritten as expected. Exits with an error if any text differs.")
+    parser.add_argument("--languages", nargs="+", choices=["es", "ca"], default=["es", "ca"], help="Space-separated languages to check.")
+
+    args = parser.parse_args()
+
+    mismatches = 0
+    for lang in args.languages:
+        rewrite = get_ling_rewriter(lang)
+        committed_texts, undone_texts = read_texts(lang)
+
+        num_rewritten = 0
+        for text in committed_texts + undone_texts:
+            expected = apply_baseline(lang, text)
+            rewritten = rewrite(text)
+            num_rewritten += expected != text
+
+            # compare the encoded texts, so that any difference (e.g. in normalization) counts
+            if rewritten.encode("utf-8") != expected.encode("utf-8"):
+                mismatches += 1
+                print(f"[{lang}] {text!r} was rewritten as {rewritten!r} instead of {expected!r} (baseline rules)")
+
+        for text, expected in adversarial_texts[lang]:
+            for rewriter_name, rewritten in [("compiled", rewrite(text)), ("baseline", apply_baseline(lang, text))]:
+                if rewritten.encode("utf-8") != expected.encode("utf-8"):
+                    mismatches += 1
+                    print(f"[{lang}] {text!r} was rewritten as {rewritten!r} by the {rewriter_name} rules instead of {expected!r}")
+
+        print(f"[{lang}] {len(committed_texts)} committed texts, {len(undone_texts)} texts with the contractions undone ({num_rewritten} rewritten by the replacements) and {len(adversarial_texts[lang])} adversarial texts checked.")
+
+    print(f"{mismatches} texts were rewritten differently.")
+
+    if mismatches:
+        sys.exit(1)
@@ -1,444 +1,1853 @@
+from __future__ import annotations
+
 import argparse
+import bisect
+import glob
+import hashlib
+import heapq
+import itertools
 import json
 import os
-import re
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional
 
-import pandas as pd
-from tabulate import tabulate
+from instance_writers import get_jsonl_index_fn, instance_writers
+from profiling import Profiler
 
 from utils import (
+    TemplateRow,
+    build_proper_names_index,
+    build_vocab_index,
+    compile_template,
     fill_template,
-    flatten_nested_dicts,
     generate_instances,
+    get_aligned_permutations,
     get_all_permutations,
     get_lex_div_combinations,
     group_by_specifiers,
     parse_dict_from_string,
     parse_list_from_string,
+    resolve_variable,
+    split_and_strip,
     validate_template
 )
 
-# overwrite the get() function of pandas Series to perform str.strip before returning when the value is a string
-# this saves us from worrying too much about extra spaces in the Excel spreadsheets
-original_get = pd.Series.get
-
-def new_get(self, key, default=None):
-    item = original_get(self, key, default)
-    return item.strip() if isinstance(item, str) else item
-
-pd.Series.get = new_get
+# pandas and tabulate are slow to import, so they are only imported in the functions that use them, so that e.g. `--help` or importing the `Generator` doesn't pay for them
+if TYPE_CHECKING:
+    import pandas as pd
 
 # rename columns to remove lang specification
 def rename_columns(df, lang):
     return df.rename(columns={c:c.rsplit("_",1)[0] for c in df.columns if c.endswith(f"_{lang}")})
 
-# formats available for the output
-output_format_choices = ["jsonl", "csv"]
+# folders where the outputs (`data_<language>/` and `stats/`) and the caches are saved by default, relative to the working directory (see `--output-dir` and `--cache-dir`)
+default_output_dir = "."
+default_cache_dir = ".cache"
 
-# languages available
-languages = ["es","ca"]
+# subfolder of the cache folder where the pre-processed spreadsheets are cached
+template_cache_dir = "templates"
 
-# get list of categories from the filenames available in the templates folder
-all_categories = sorted([re.match(r"esbbq_(\w+)_ca_gl.xlsx", fn).group(1) for fn in os.listdir("templates") if fn.startswith("esbbq_")])
+# bump this whenever the pre-processing in the read_*_spreadsheet functions changes, so that old cache files are not used
+template_cache_version = 2
 
-# create parser for the CLI arguments
-parser = argparse.ArgumentParser(prog="Generate EsBBQ Instances", description="This script will read the Excel files in the input folder and generate EsBBQ instances for all the categories. By default, generates instances from all the templates in all the categories.")
-parser.add_argument("--language", choices=languages, help="language to process templates and generate instances.", required=True)
-parser.add_argument("--categories", nargs="+", choices=all_categories, default=all_categories, help="Space-separated list of categories to process templates and generate instances. If not passed, will run for all available categories.")
-parser.add_argument("--minimal", action="store_true", help="Minimize the sources of variation in instances by only taking one option from each source of variation.")
-parser.add_argument("--output-formats", nargs="+", choices=output_format_choices, default=output_format_choices, help="Space-separated format(s) in which to save the instances.")
-parser.add_argument("--dry-run", action="store_true", help="Generate the templates and print the logs and stats but don't actually save them to file.")
-parser.add_argument("--no-proper-names", action="store_true", help="Ignore the templates that require proper names in all categories contemplated.")
-parser.add_argument("--save-fertility", action="store_true", help="Save an extra CSV with the fertility (instance count) of each template.")
+# bump this whenever the code that generates the instances of a template row changes (filling, linguistic replacements, permutations, answers...), so that --incremental does not reuse the instances of a previous run
+generator_version = 1
 
-args = parser.parse_args()
+def read_vocabulary_spreadsheet(fn, langs):
+    import pandas as pd
 
-# get language
-lang = args.language
+    df_vocab = pd.read_excel(fn).fillna("")
 
-# read and pre-process vocabulary files
-df_vocab = pd.read_excel("templates/vocabulary.xlsx").fillna("")
-df_proper_names = pd.read_excel("templates/vocabulary_proper_names.xlsx").fillna("")
+    # only keep the rows where include_name is empty (not FALSE)
+    df_vocab = df_vocab[df_vocab.include_name == ""]
 
-# only keep the rows where include_name is empty (not FALSE)
-df_vocab = df_vocab[df_vocab.include_name == ""]
+    df_vocabs = {}
+    for lang in langs:
+        # filter columns according to language
+        # for catalan, vocab file also include version with def articles to avoid linguistic errors
+        if lang == "ca":
+            df_vocab_lang = df_vocab[["category", "subcategory", f"name_{lang}", f"name_def_{lang}", f"f_{lang}",  f"f_def_{lang}", "information"]].map(str.strip)
+        else:
+            df_vocab_lang = df_vocab[["category", "subcategory", f"name_{lang}", f"f_{lang}", "information"]].map(str.strip)
 
-# filter columns according to language
-# for catalan, vocab file also include version with def articles to avoid linguistic errors
-if lang == "ca":
-    df_vocab = df_vocab[["category", "subcategory", f"name_{lang}", f"name_def_{lang}", f"f_{lang}",  f"f_def_{lang}", "information"]].map(str.strip)
-    df_proper_names = df_proper_names[[f"proper_name_{lang}", f"proper_name_def_{lang}", "gender", f"ethnicity_{lang}"]].map(str.strip)
-else:
-    df_vocab = df_vocab[["category", "subcategory", f"name_{lang}", f"f_{lang}", "information"]].map(str.strip)
-    df_proper_names = df_proper_names[[f"proper_name_{lang}", "gender", f"ethnicity_{lang}"]].map(str.strip)
+        # rename columns
+        df_vocabs[lang] = rename_columns(df_vocab_lang,lang)
 
-# rename columns
-df_vocab = rename_columns(df_vocab,lang)
-df_proper_names = rename_columns(df_proper_names,lang)
+    return df_vocabs
 
-# initialize DF for the statistics per category
-df_stats = pd.DataFrame(index=args.categories)
+def read_proper_names_spreadsheet(fn, langs):
+    import pandas as pd
 
-# iterate over categories to read all the templates and fill them in
-for curr_category in args.categories:
+    df_proper_names = pd.read_excel(fn).fillna("")
 
-    # read the category's Excel spreadsheet of templates
-    df_category = pd.read_excel(f"templates/{curr_category}.xlsx", sheet_name="Sheet1", na_filter=False).fillna("")
+    df_proper_names_langs = {}
+    for lang in langs:
+        # filter columns according to language
+        if lang == "ca":
+            df_proper_names_lang = df_proper_names[[f"proper_name_{lang}", f"proper_name_def_{lang}", "gender", f"ethnicity_{lang}"]].map(str.strip)
+        else:
+            df_proper_names_lang = df_proper_names[[f"proper_name_{lang}", "gender", f"ethnicity_{lang}"]].map(str.strip)
 
-    # filter columns according to language
-    if lang == "es":
-        df_category = df_category.drop(columns=[column for column in df_category.columns if column.endswith("_ca")])
-    elif lang == "ca":
-        df_category = df_category.drop(columns=[column for column in df_category.columns if column.endswith("_es")])
+        # rename columns
+        df_proper_names_langs[lang] = rename_columns(df_proper_names_lang,lang)
 
-    # rename columns
-    df_category = rename_columns(df_category,lang)
+    return df_proper_names_langs
 
-    print(f"[{curr_category}] Imported {len(df_category)} templates.")
+def read_category_spreadsheet(fn, langs):
+    import pandas as pd
 
-    # save the number of templates in stats
-    df_stats.at[curr_category, "num_templates"] = len(set(df_category.esbbq_template_id))
-    df_stats.at[curr_category, "num_rows"] = len(df_category)
+    df_category = pd.read_excel(fn, sheet_name="Sheet1", na_filter=False).fillna("")
 
-    # generate all possible templates with permutations of NAME1 and NAME2
-    if not args.minimal:
-        df_category = get_all_permutations(df_category)
+    df_categories = {}
+    for lang in langs:
+        # filter columns according to language (dropping the columns of the other languages)
+        df_category_lang = df_category.drop(columns=[column for column in df_category.columns if any(column.endswith(f"_{other_lang}") for other_lang in languages if other_lang != lang)])
 
-    # initialize list that will contain all the instances generated for all the templates in this category
-    generated_instances: list[dict] = []
+        # rename columns
+        df_categories[lang] = rename_columns(df_category_lang,lang)
 
-    # iterate over template rows to generate instances for one template at a time
-    for _, curr_row in df_category.iterrows():
-        """
-        ROW CONFIG
-        """
+    return df_categories
 
-        validate_template(curr_row)
+def read_spreadsheet_cached(fn: str, langs: list[str], read_function: Callable[[str, list[str]], dict[str, pd.DataFrame]], use_cache: bool = True, cache_dir: str = default_cache_dir) -> dict[str, pd.DataFrame]:
+    """
+    Reads and pre-processes a spreadsheet with the given function, caching the resulting DataFrames as a pickle under `template_cache_dir` in the cache folder.
+    The spreadsheet is only read once for all the languages, and the cache files are keyed by the hash of the contents of the spreadsheet and the languages, so they are invalidated automatically whenever the spreadsheet changes.
 
-        # dictionaries that will store pre-processed values from the names column and the lexical diversity column
-        grouped_names_dict = {}
-        grouped_lex_div_dict = {}
+    Args:
+        fn (str): Path to the Excel spreadsheet.
+        langs (list[str]): Languages to filter the columns of the spreadsheet.
+        read_function (Callable[[str, list[str]], dict[str, pd.DataFrame]]): Function that reads the spreadsheet and returns the pre-processed DataFrame for each of the given languages.
+        use_cache (bool): Whether to read and write the cache at all.
+        cache_dir (str): The cache folder.
 
-        # options and information for NAME1 values
-        name1_list = []
-        name1_info = ""
-        name1_info_dict = {}
+    Returns:
+        dict[str, pd.DataFrame]: The pre-processed DataFrame of each language.
+    """
 
-        # options and information for NAME2 values
-        name2_list = []
-        name2_info = ""
-        name2_info_dict = {}
+    import pandas as pd
 
-        # count the instances generated for this specific template, for fertility stats
-        instance_count = 0
+    if not use_cache:
+        return read_function(fn, langs)
 
-        # pre-process the column of stated gender in the cases where the template should be used only for one gender
-        stated_gender: str = curr_row.get("stated_gender_info", "").lower()
-        if "fake-" in stated_gender:
-            # treat the case of "fake-m" and "fake-f" (used to differentiate from "m/f" when it's only grammatical gender)
-            stated_gender = stated_gender.split("-")[1]
-        assert stated_gender in ["m", "f", ""], f"Invalid value for stated_gender_info: `{stated_gender}`"
+    with open(fn, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
 
-        # determine whether NAME1 and NAME2 need to be proper names
-        proper_names_only: bool = bool(curr_row.get("proper_nouns_only", ""))
+    spreadsheet_cache_dir = os.path.join(cache_dir, template_cache_dir)
+    cache_prefix = os.path.join(spreadsheet_cache_dir, f"{os.path.basename(fn)}.{'-'.join(langs)}.")
+    cache_fn = f"{cache_prefix}v{template_cache_version}.{content_hash[:16]}.pkl"
 
-        if proper_names_only and args.no_proper_names:
-            # if the option to ignore proper names was passed and the current template is for proper names, skip it
-            continue
+    if os.path.exists(cache_fn):
+        return pd.read_pickle(cache_fn)
 
-        """
-        NAME1 AND NAME2 VALUES
-        """
+    dfs = read_function(fn, langs)
+
+    # remove the outdated cache files of this spreadsheet and languages before saving the new one
+    os.makedirs(spreadsheet_cache_dir, exist_ok=True)
+    for old_fn in glob.glob(glob.escape(cache_prefix) + "*.pkl"):
+        os.remove(old_fn)
+
+    # write to a temporary file first so that concurrent workers never read a half-written cache file
+    tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    pd.to_pickle(dfs, tmp_fn)
+    os.replace(tmp_fn, cache_fn)
+
+    return dfs
+
+# subfolder of the cache folder where the hashes of the template rows used to generate each output file are stored (see `--incremental`)
+incremental_cache_dir = "incremental"
+
+def get_data_dir(lang: str, args: argparse.Namespace) -> str:
+    """
+    Returns the folder where the instances of a language are saved (`data_<language>/` in the output folder).
+    """
+    return os.path.normpath(os.path.join(args.output_dir, f"data_{lang}"))
+
+def get_stats_dir(lang: str, args: argparse.Namespace) -> str:
+    """
+    Returns the folder where the fertility and timing of the templates of a language are saved (`stats/<language>/template_fertility/` in the output folder).
+    """
+    return os.path.normpath(os.path.join(args.output_dir, "stats", lang, "template_fertility"))
+
+def hash_values(*values) -> str:
+    """
+    Computes a SHA-256 hash of the given values, which can be anything that is JSON-serializable, DataFrames or Series.
+    """
+    import pandas as pd
+
+    values = [value.to_json(orient="split") if isinstance(value, (pd.DataFrame, pd.Series)) else value for value in values]
+    return hashlib.sha256(json.dumps(values, default=str, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def get_template_row_hashes(df_category: pd.DataFrame, curr_category: str, lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace) -> list[str]:
+    """
+    Computes a content hash for each template row, covering all of its columns (template ID, version, texts, names, etc.), the slice of the vocabulary that can be used to fill it, the generation options that change the instances and the version of the generation code (`generator_version`).
+    If the hash of a row does not change between two runs, the row generates exactly the same instances.
+    """
+
+    # vocabulary of the category plus the non-stereotyped groups, which are also looked up in the full vocabulary
+    vocab_hash = hash_values(df_vocab[(df_vocab.category == curr_category) | (df_vocab.information == "not-stereotyped")])
+    proper_names_hash = hash_values(df_proper_names)
+    options = [generator_version, lang, args.minimal, args.no_proper_names, args.max_lex_div_combinations]
+
+    # instances generated along with other languages are deduplicated jointly (see `deduplicate_instances`), so they can't be reused when generating one language only
+    if len(args.language) > 1:
+        options.append(args.language)
+
+    return [hash_values(row.to_dict(), vocab_hash, proper_names_hash if row.get("proper_nouns_only") else None, options) for _, row in df_category.iterrows()]
+
+def load_reusable_instances(hashes_fn: str, jsonl_fn: str, df_category: pd.DataFrame, row_hashes: list[str]) -> dict:
+    """
+    Finds the template rows whose instances can be copied from the output of a previous run instead of generating them again.
+    Instances are only deduplicated among rows with the same template ID, so all the rows of a template are reused or regenerated together: they are only reused if the template has exactly the same row hashes, in the same order, as in the previous run.
+    The instances are not read here: the sidecar index of the JSONL file (see `instance_writers.get_jsonl_index_fn`) gives the byte range of the instances of each row, which are only read when they are spliced into the output (see `read_previous_instances`).
+
+    Args:
+        hashes_fn (str): JSON file with the hashes and instance counts of the rows used in the previous run.
+        jsonl_fn (str): JSONL file with the instances generated in the previous run.
+        df_category (pd.DataFrame): The current templates of the category.
+        row_hashes (list[str]): The current hash of each template row.
+
+    Returns:
+        dict: Mapping of the index of each reusable row to an iterator over the instances (without ID) that it generated in the previous run.
+    """
+
+    index_fn = get_jsonl_index_fn(jsonl_fn)
+    if not (os.path.exists(hashes_fn) and os.path.exists(jsonl_fn) and os.path.exists(index_fn)):
+        return {}
+
+    with open(hashes_fn) as f:
+        previous_run = json.load(f)
+
+    with open(index_fn) as f:
+        index = json.load(f)
+
+    # make sure that the instances file and its index have not been modified after the previous run (the file is hashed in chunks, not loaded)
+    jsonl_hash = hashlib.sha256()
+    with open(jsonl_fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            jsonl_hash.update(chunk)
+
+    if not (jsonl_hash.hexdigest() == index["jsonl_sha256"] == previous_run["jsonl_sha256"] and len(index["offsets"]) == sum(previous_row["instances"] for previous_row in previous_run["rows"])):
+        return {}
+
+    # split the previous instances into the byte ranges of the ones generated by each row, grouped by template
+    line_offsets = index["offsets"] + [index["jsonl_size"]]
+    previous_templates = {}
+    start = 0
+    for previous_row in previous_run["rows"]:
+        end = start + previous_row["instances"]
+        previous_templates.setdefault(str(previous_row["template_id"]), []).append((previous_row["hash"], (line_offsets[start], line_offsets[end])))
+        start = end
+
+    current_templates = {}
+    for row_idx, template_id, row_hash in zip(df_category.index, df_category.esbbq_template_id, row_hashes):
+        current_templates.setdefault(str(template_id), []).append((row_idx, row_hash))
+
+    reusable_instances = {}
+    for template_id, current_rows in current_templates.items():
+        previous_rows = previous_templates.get(template_id, [])
+        if [row_hash for row_hash, _ in previous_rows] == [row_hash for _, row_hash in current_rows]:
+            for (row_idx, _), (_, (start_offset, end_offset)) in zip(current_rows, previous_rows):
+                reusable_instances[row_idx] = read_previous_instances(jsonl_fn, start_offset, end_offset)
+
+    return reusable_instances
+
+def read_previous_instances(jsonl_fn: str, start_offset: int, end_offset: int) -> Iterator[dict]:
+    """
+    Reads the instances saved between two byte offsets of the JSONL file of a previous run, one line at a time and without their ID.
+    As a generator, the file is not opened until the instances are requested, so only the instances being spliced into the output are in memory.
+    """
+    with open(jsonl_fn, "rb") as f:
+        f.seek(start_offset)
+        while f.tell() < end_offset:
+            instance = json.loads(f.readline())
+            del instance["instance_id"]
+            yield instance
+
+# formats in which the instances can be saved (parquet requires pyarrow and is not generated by default)
+output_format_choices = ["jsonl", "csv", "parquet"]
+default_output_formats = ["jsonl", "csv"]
 
+# languages available
+languages = ["es","ca"]
+
+# folder with the spreadsheets of templates and vocabulary (see `--templates-dir`)
+default_templates_dir = "templates"
+
+def get_categories(templates_dir: str = default_templates_dir) -> list[str]:
+    """
+    Returns the list of categories from the filenames available in the templates folder (every spreadsheet except the vocabulary ones).
+    """
+    return sorted([fn.removesuffix(".xlsx") for fn in os.listdir(templates_dir) if fn.endswith(".xlsx") and not fn.startswith("vocabulary")])
+
+def get_row_config(curr_category: str, curr_row: TemplateRow, df_vocab: pd.DataFrame, vocab_indexes: dict, args: argparse.Namespace) -> Optional[dict]:
+    """
+    Pre-processes the columns of a template row that determine the values its variables can take: stated gender, proper names, stereotyped groups, names column and lexical diversity.
+
+    Args:
+        curr_category (str): The category of the template.
+        curr_row (TemplateRow): The template row.
+        df_vocab (pd.DataFrame): The vocabulary of all the categories.
+        vocab_indexes (dict): Cache of the vocabulary of each subcategory of the category and its index, which is filled as needed.
+
+    Returns:
+        Optional[dict]: The configuration of the row, or None if the row must be skipped.
+    """
+
+    # dictionaries that will store pre-processed values from the names column and the lexical diversity column
+    grouped_names_dict = {}
+    grouped_lex_div_dict = {}
+
+    # pre-process the column of stated gender in the cases where the template should be used only for one gender
+    stated_gender: str = curr_row.stated_gender_info.lower()
+    if "fake-" in stated_gender:
+        # treat the case of "fake-m" and "fake-f" (used to differentiate from "m/f" when it's only grammatical gender)
+        stated_gender = stated_gender.split("-")[1]
+    assert stated_gender in ["m", "f", ""], f"Invalid value for stated_gender_info: `{stated_gender}`"
+
+    # determine whether NAME1 and NAME2 need to be proper names
+    proper_names_only: bool = bool(curr_row.proper_nouns_only)
+
+    if proper_names_only and args.no_proper_names:
+        # if the option to ignore proper names was passed and the current template is for proper names, skip it
+        return None
+
+    curr_subcategory = curr_row.subcategory
+    if curr_subcategory not in vocab_indexes:
         # select the words from the vocab that match the current category
         df_vocab_cat = df_vocab[(df_vocab.category == curr_category)]
 
         # filter by subcategory if there is one
-        curr_subcategory = curr_row.get("subcategory")
         if curr_subcategory:
                 # filter the vocabulary for the given subcategory only
                 df_vocab_cat = df_vocab_cat[df_vocab_cat.subcategory == curr_subcategory]
 
-        # parse the list of stereotyped groups (i.e. bias targets) that the current template refers to
-        bias_targets: str = parse_list_from_string(curr_row.stereotyped_groups)
+        vocab_indexes[curr_subcategory] = (df_vocab_cat, build_vocab_index(df_vocab_cat))
+    df_vocab_cat, vocab_index = vocab_indexes[curr_subcategory]
+
+    # parse the list of stereotyped groups (i.e. bias targets) that the current template refers to
+    bias_targets: str = parse_list_from_string(curr_row.stereotyped_groups)
+
+    # get specific vocabulary from the names column if available
+    # (values in the names column always override vocabulary that would otherwise be used,
+    # and they can only be used when the template is not for proper names)
+    names_str = curr_row.names
+    if names_str and not proper_names_only:
+        names_dict = parse_dict_from_string(names_str)
+        grouped_names_dict = group_by_specifiers(names_dict)
+
+    """
+    LEXICAL DIVERSITY
+    """
+
+    lex_div_str: str = curr_row.lexical_diversity
+    if lex_div_str:
+        lex_div_dict = parse_dict_from_string(lex_div_str)
+        grouped_lex_div_dict = group_by_specifiers(lex_div_dict)
+
+        # all the possible combinations of WORD1, WORD2, ..., WORD<N>, which are created as they are used
+        # (only the first one in minimal mode, and at most --max-lex-div-combinations otherwise)
+        max_combinations = 1 if args.minimal else args.max_lex_div_combinations or None
+        lex_div_combinations = get_lex_div_combinations(grouped_lex_div_dict, max_combinations)
+        lex_div_capped = lex_div_combinations.truncated and not args.minimal
+
+        # warn only once per row, not for each of its permutations
+        if lex_div_capped and curr_row.flipped in (None, "original"):
+            print(f"[{curr_category}] WARNING: Template {curr_row.esbbq_template_id}{curr_row.version} has {lex_div_combinations.num_combinations} combinations of lexical diversity, only the first {len(lex_div_combinations)} will be used (see --max-lex-div-combinations).")
+
+    else:
+        # if there is no lexical diversity, create a list with one combination set to None so that we can still loop over the "combinations" and only generate one
+        lex_div_combinations = [None]
+        lex_div_capped = False
+        grouped_lex_div_dict = {}
+
+    return {
+        "stated_gender": stated_gender,
+        "proper_names_only": proper_names_only,
+        "df_vocab_cat": df_vocab_cat,
+        "vocab_index": vocab_index,
+        "bias_targets": bias_targets,
+        "grouped_names_dict": grouped_names_dict,
+        "grouped_lex_div_dict": grouped_lex_div_dict,
+        "lex_div_combinations": lex_div_combinations,
+        "lex_div_capped": lex_div_capped,
+    }
+
+def iter_name_pairs(curr_category: str, curr_row: TemplateRow, row_config: dict, df_vocab: pd.DataFrame, full_vocab_index: dict, df_proper_names: pd.DataFrame, args: argparse.Namespace) -> Iterator[tuple[str, str, str, str]]:
+    """
+    Generates the values that NAME1 and NAME2 take in the instances of a template row, following the rules of each category (e.g. in SES and RaceEthnicity the options for NAME2 depend on NAME1).
+
+    Args:
+        curr_category (str): The category of the template.
+        curr_row (TemplateRow): The template row.
+        row_config (dict): The configuration of the row, as returned by `get_row_config`.
+        df_vocab (pd.DataFrame): The vocabulary of all the categories.
+        full_vocab_index (dict): The index of the vocabulary of all the categories.
+        df_proper_names (pd.DataFrame): The proper names.
+
+    Yields:
+        tuple[str, str, str, str]: The values of NAME1 and NAME2, and the information strings referring to each of them.
+    """
+
+    stated_gender = row_config["stated_gender"]
+    proper_names_only = row_config["proper_names_only"]
+    df_vocab_cat = row_config["df_vocab_cat"]
+    vocab_index = row_config["vocab_index"]
+    bias_targets = row_config["bias_targets"]
+    grouped_names_dict = row_config["grouped_names_dict"]
+    curr_subcategory = curr_row.subcategory
+
+    # options and information for NAME1 values
+    name1_list = []
+    name1_info = ""
+    name1_info_dict = {}
+
+    # options and information for NAME2 values
+    name2_list = []
+    name2_info = ""
+    name2_info_dict = {}
+
+    """
+    NAME1 AND NAME2 VALUES
+    """
+
+    if proper_names_only:
+
+        # for RaceEthnicity, generate NAME1 options using names associated with the targeted ethnicities
+        if curr_category == "RaceEthnicity":
+            assert bias_targets, "Category is RaceEthnicity but the template doesn't have any specified stereotyped groups!"
+
+            df_names = df_proper_names[df_proper_names.ethnicity.isin(bias_targets)]
+
+            if stated_gender:
+                # if the template states a specific gender to use, restrict to this gender or to genderless names
+                df_names = df_names[df_names.gender.isin([stated_gender, ""])]
+
+            # iterate over names to save them in the NAME1 list and store info
+            for _, row in df_names.iterrows():
+                    name = row.proper_name
+                    name_info = f"{row.gender}, {row.ethnicity}"
+                    name1_list.append(name)
+                    name1_info_dict[name] = name_info
+
+        # for Gender with proper names, NAME1 is always female and NAME2 is always male
+        elif curr_category == "Gender":
+            # we use only white names to avoid introducing additional bias by comparing between stereotyped ethnicities
+            df_names = df_proper_names[(df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")]
+            assert len(df_names)
+
+            # force NAME1 to be female
+            name1_list = df_names[df_names.gender == "f"].proper_name.unique().tolist()
+            name1_info_dict.update({name : "f" for name in name1_list})
+
+            # force NAME2 to be male
+            name2_list = df_names[df_names.gender == "m"].proper_name.unique().tolist()
+            name2_info_dict.update({name : "m" for name in name2_list})
+
+        # In the case of other categories that use proper nouns, they can be of any gender but we don't want them to elicit any specific ethnicities so we take only typical white Spanish names
+        else:
+            df_names = df_proper_names[(df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")]
+            df_names = df_names[df_names.gender.isin([stated_gender, ""])]
 
-        df_names = pd.DataFrame()
-        df_other_names = pd.DataFrame()
+            name1_list = df_names.proper_name.tolist()
 
-        if proper_names_only:
+    else: # if not using proper names
 
-            # for RaceEthnicity, generate NAME1 options using names associated with the targeted ethnicities
-            if curr_category == "RaceEthnicity":
-                assert bias_targets, "Category is RaceEthnicity but the template doesn't have any specified stereotyped groups!"
+        if curr_category == "SES" and curr_subcategory == "Occupation":
+            # for SES Occupations, options for NAME1 are all the occupations listed in the vocabulary
+            name1_list = df_vocab_cat.name.unique().tolist()
 
-                df_names = df_proper_names[df_proper_names.ethnicity.isin(bias_targets)]
+        elif curr_category != "Gender":
+        # options for NAME1 are simply the bias targets
+            name1_list = bias_targets
+
+        if not name2_list:
+            curr_non_stereotyped = curr_row.non_stereotyped_groups
+            if curr_non_stereotyped:
+                name2_list = parse_list_from_string(curr_non_stereotyped)
+            else:
+                # initialize the options for NAME2 as the groups marked in the vocabulary as non-stereotyped, if any
+                df_vocab_non_stereotyped = df_vocab_cat[df_vocab_cat.information == "not-stereotyped"]
+                name2_list = df_vocab_non_stereotyped.name.unique().tolist()
+
+        # values in the names column always override vocabulary that would otherwise be used
+        if grouped_names_dict:
+            name1_list = grouped_names_dict["NAME1"][None]
+            name2_list = grouped_names_dict["NAME2"][None]
+
+    if args.minimal:
+        name1_list = name1_list[:1]
+
+    assert name1_list, "No names in the list of options for NAME1!"
+
+    """
+    NAME1 LOOP
+    Iterate over the list of possible values for NAME1
+    """
+
+    for name1 in name1_list:
+
+        # set info field
+        if name1 in name1_info_dict:
+            name1_info = name1_info_dict[name1]
+        else:
+            name1_info = curr_row.NAME1_info
+
+        # set possible values for NAME2 here when they depend on NAME1
+        # (in which case they could not be determined before the NAME1 loop)
+        if curr_category == "SES":
+            if proper_names_only:
+                # for SES with proper names, take NAME2 from the remaining white names different from NAME1
+                df_other_names = df_proper_names[((df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")) & (df_proper_names.proper_name != name1)]
 
                 if stated_gender:
                     # if the template states a specific gender to use, restrict to this gender or to genderless names
-                    df_names = df_names[df_names.gender.isin([stated_gender, ""])]
-                
-                # iterate over names to save them in the NAME1 list and store info
-                for _, row in df_names.iterrows():
-                        name = row.proper_name
-                        name_info = f"{row.gender}, {row.ethnicity}"
-                        name1_list.append(name)
-                        name1_info_dict[name] = name_info
-
-            # for Gender with proper names, NAME1 is always female and NAME2 is always male
-            elif curr_category == "Gender":
-                # we use only white names to avoid introducing additional bias by comparing between stereotyped ethnicities
-                df_names = df_proper_names[(df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")]
-                assert len(df_names)
-
-                # force NAME1 to be female
-                name1_list = df_names[df_names.gender == "f"].proper_name.unique().tolist()
-                name1_info_dict.update({name : "f" for name in name1_list})
-
-                # force NAME2 to be male
-                name2_list = df_names[df_names.gender == "m"].proper_name.unique().tolist()
-                name2_info_dict.update({name : "m" for name in name2_list})
-
-            # In the case of other categories that use proper nouns, they can be of any gender but we don't want them to elicit any specific ethnicities so we take only typical white Spanish names
-            else:
-                df_names = df_proper_names[(df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")]
-                df_names = df_names[df_names.gender.isin([stated_gender, ""])]
+                    df_other_names = df_other_names[df_other_names.gender.isin([stated_gender, ""])]
 
-                name1_list = df_names.proper_name.tolist()
+                name2_list = df_other_names.proper_name.tolist()
 
-        else: # if not using proper names
+            elif curr_subcategory == "Occupation":
+            # for SES Occupations, NAME1 options can be either highSES or lowSES, so we ensure that NAME2 options are always in the opposite category
+                name1_info = vocab_index[name1]["information"]
+                name2_list = [name for name, vocab_row in vocab_index.items() if vocab_row["information"] != name1_info]
 
-            if curr_category == "SES" and curr_subcategory == "Occupation":
-                # for SES Occupations, options for NAME1 are all the occupations listed in the vocabulary
-                name1_list = df_vocab_cat.name.unique().tolist()
+        # for race/ethnicity, NAME2 options should be the same gender as NAME1 but with the non-stereotyped ethnicity
+        elif curr_category == "RaceEthnicity" and proper_names_only:
 
-            elif curr_category != "Gender":
-            # options for NAME1 are simply the bias targets
-                name1_list = bias_targets
+            # find the non-stereotyped ethnicity
+            non_stereotyped_groups = df_vocab[df_vocab.information == "not-stereotyped"].name.unique().tolist()
 
-            if not name2_list:
-                curr_non_stereotyped = curr_row.get("non_stereotyped_groups")
-                if curr_non_stereotyped:
-                    name2_list = parse_list_from_string(curr_non_stereotyped)
-                else:
-                    # initialize the options for NAME2 as the groups marked in the vocabulary as non-stereotyped, if any
-                    df_vocab_non_stereotyped = df_vocab_cat[df_vocab_cat.information == "not-stereotyped"]
-                    name2_list = df_vocab_non_stereotyped.name.unique().tolist()
+            # filter the proper names to those of the non-stereotyped ethnicity and same gender as NAME1
+            gender = name1_info.split(",")[0]
+            df_other_names = df_proper_names[(df_proper_names.ethnicity.isin(non_stereotyped_groups)) & (df_proper_names.gender == gender)]
 
-            # get specific vocabulary from the names column if available
-            # (values in the names column always override vocabulary that would otherwise be used,
-            # and they can only be used when the template is not for proper names)
-            names_str = curr_row.get("names", "")
-            if names_str:
-                names_dict = parse_dict_from_string(names_str)
-                grouped_names_dict = group_by_specifiers(names_dict)
+            # iterate over names to add them to the NAME2 list and save info
+            for _, name_row in df_other_names.iterrows():
+                name = name_row.proper_name
+                name2_list.append(name)
+                name2_info_dict[name] = name_row.ethnicity
 
-                name1_list = grouped_names_dict["NAME1"][None]
-                name2_list = grouped_names_dict["NAME2"][None]
+        assert name2_list, "No names in the list of options for NAME2!"
 
         if args.minimal:
-            name1_list = name1_list[:1]
+            name2_list = name2_list[:1]
+
+        """
+        NAME2 LOOP
+        Iterate over all the names in the NAME2 list
+        """
+        for name2 in name2_list:
+            if name2 in name2_info_dict:
+                name2_info = name2_info_dict[name2]
+            else:
+                name2_info = curr_row.NAME2_info
+
+            if curr_category == "RaceEthnicity" and proper_names_only:
+                name2_info = name2_info_dict[name2]
+
+            elif curr_category == "Gender" and proper_names_only:
+                # if there is already some info on the row, append it to the existing information
+                if curr_row.NAME1_info and curr_row.NAME1_info != name1_info:
+                    name1_info = f"{name1_info}, {curr_row.NAME1_info}"
+                if curr_row.NAME2_info and curr_row.NAME2_info != name2_info:
+                    name2_info = f"{name2_info}, {curr_row.NAME2_info}"
+
+                if "m, m" in name1_info or "m, m" in name2_info:
+                    breakpoint()
+
+            elif curr_category == "SES" and curr_subcategory == "Occupation":
+                # get the info about each name from the vocab
+                name1_info = full_vocab_index[name1]["information"]
+                name2_info = full_vocab_index[name2]["information"]
+
+            # if there is still no info, use the name itself
+            if not name1_info:
+                name1_info = name1
+
+            if not name2_info:
+                name2_info = name2
+
+            yield name1, name2, name1_info, name2_info
+
+def fill_instances(lang: str, curr_row: TemplateRow, row_config: dict, name_pair: tuple[str, str, str, str], lex_div_assignment: Optional[dict], names_index: dict, compiled_template: dict, profiler: Profiler) -> list[dict]:
+    """
+    Fills a template row with a pair of names and a lexical diversity combination, and creates the four instances that use the filled texts.
+
+    Args:
+        curr_row (TemplateRow): The template row (or one of its permutations).
+        row_config (dict): The configuration of the row, as returned by `get_row_config`.
+        name_pair (tuple[str, str, str, str]): The values of NAME1 and NAME2 and their information, as generated by `iter_name_pairs`.
+        lex_div_assignment (Optional[dict]): The option of each WORD label, if the row has lexical diversity.
+        names_index (dict): The index of the proper names.
+        compiled_template (dict): The text columns of the row compiled by `compile_template`.
+        profiler (Profiler): Profiler of the category, to which the time spent filling and assembling is attributed per template.
+
+    Returns:
+        list[dict]: The instances (without ID), or an empty list if the template can't be filled with these values.
+    """
+
+    name1, name2, name1_info, name2_info = name_pair
+
+    # template (ID and version) to which the time spent on this row is attributed when profiling
+    template_key = (curr_row.esbbq_template_id, curr_row.version)
+
+    with profiler.stage("fill", template=template_key):
+        new_row, values_used = fill_template(language=lang,
+                                            template_row=curr_row,
+                                            name1=name1,
+                                            # gs_name1=None,
+                                            name2=name2,
+                                            # gs_name2=None,
+                                            names_dict=row_config["grouped_names_dict"],
+                                            lex_div_dict=row_config["grouped_lex_div_dict"],
+                                            lex_div_assignment=lex_div_assignment,
+                                            stated_gender=row_config["stated_gender"],
+                                            vocab_index=row_config["vocab_index"],
+                                            proper_names_only=row_config["proper_names_only"],
+                                            names_index=names_index,
+                                            compiled_template=compiled_template
+                                            )
+
+    if new_row is None:
+        return []
+
+    # with the texts filled, create all possible instances that use them
+    with profiler.stage("assembly", template=template_key):
+        return list(generate_instances(language=lang, row=new_row, bias_targets=row_config["bias_targets"], values_used=values_used, name1_info=name1_info, name2_info=name2_info, proper_names_only=row_config["proper_names_only"]))
+
+def generate_category_instances(curr_category: str, template_rows: list[tuple[int, TemplateRow]], lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace, reusable_instances: dict, profiler: Profiler) -> Iterator[tuple[int, dict]]:
+    """
+    Fills the templates of a category and generates their instances one at a time, so that they can be streamed to the output files without keeping them all in memory.
+
+    Args:
+        curr_category (str): The category of the templates.
+        template_rows (list[tuple[int, TemplateRow]]): The template rows of the category (with all their permutations, if any), each with the index of the original row in the spreadsheet.
+        reusable_instances (dict): Instances from the previous run to splice in instead of generating them again, indexed by template row (see `load_reusable_instances`), which are read from the previous output as they are spliced in.
+        profiler (Profiler): Profiler of the category, which measures the time spent filling the templates and assembling the instances of each template.
+
+    Yields:
+        tuple[int, dict]: The index of the template row that generated the instance and the instance itself (without ID).
+    """
+
+    # rows whose instances are copied from the previous run instead of generated
+    reused_rows = set(reusable_instances)
+
+    # build the indexes to look up names in the vocabulary and proper names
+    # (the vocabulary index of the category is built once per subcategory, when needed)
+    full_vocab_index = build_vocab_index(df_vocab)
+    names_index = build_proper_names_index(df_proper_names)
+    vocab_indexes = {}
+
+    # iterate over template rows to generate instances for one template at a time
+    for row_idx, curr_row in template_rows:
 
-        assert name1_list, "No names in the list of options for NAME1!"
+        if row_idx in reused_rows:
+            # splice in the instances generated by this row in the previous run (only once, not for each permutation of the row)
+            for instance in reusable_instances.pop(row_idx, []):
+                yield row_idx, instance
+            continue
 
         """
-        LEXICAL DIVERSITY
+        ROW CONFIG
         """
 
-        lex_div_str: str = curr_row.get("lexical_diversity", "")
-        if lex_div_str:
-            lex_div_dict = parse_dict_from_string(lex_div_str)
-            grouped_lex_div_dict = group_by_specifiers(lex_div_dict)
+        validate_template(curr_row)
+
+        row_config = get_row_config(curr_category, curr_row, df_vocab, vocab_indexes, args)
+        if row_config is None:
+            continue
+
+        # split the texts of the row into literal segments and slots once, to fill them for all the combinations below
+        compiled_template = compile_template(curr_row)
+
+        for name1, name2, name1_info, name2_info in iter_name_pairs(curr_category, curr_row, row_config, df_vocab, full_vocab_index, df_proper_names, args):
+
+            # iterate over combinations to generate every possible version of the texts
+            for curr_lex_div in row_config["lex_div_combinations"]:
+                for instance in fill_instances(lang, curr_row, row_config, (name1, name2, name1_info, name2_info), curr_lex_div, names_index, compiled_template, profiler):
+                    yield row_idx, instance
+
+def generate_aligned_instances(curr_category: str, aligned_rows: list[tuple[int, dict[str, TemplateRow]]], df_vocabs: dict[str, pd.DataFrame], df_proper_names: dict[str, pd.DataFrame], args: argparse.Namespace, profiler: Profiler) -> Iterator[tuple[int, dict[str, dict]]]:
+    """
+    Fills the templates of a category in several languages in a single traversal and generates their instances one at a time, so that the instances of all the languages are aligned by construction: they come from the same template row, permutation, pair of names and lexical diversity combination (by position).
+    The templates of all the languages are translations of each other, but a row may have a different number of pairs of names or lexical diversity combinations in each language. The instances of those rows can't be aligned, so they are skipped in all the languages with a warning.
+
+    Args:
+        curr_category (str): The category of the templates.
+        aligned_rows (list[tuple[int, dict[str, TemplateRow]]]): The template rows of the category in each language (with all their permutations, if any, see `get_aligned_permutations`), each with the index of the original row in the spreadsheet.
+        df_vocabs (dict[str, pd.DataFrame]): The vocabulary of each language.
+        df_proper_names (dict[str, pd.DataFrame]): The proper names of each language.
+        profiler (Profiler): Profiler of the category, which measures the time spent filling the templates and assembling the instances of each template.
+
+    Yields:
+        tuple[int, dict[str, dict]]: The index of the template row that generated the instances and the instance of each language (without ID).
+    """
+
+    langs = list(df_vocabs)
+
+    # build the indexes to look up names in the vocabulary and proper names of each language
+    full_vocab_indexes = {lang: build_vocab_index(df_vocabs[lang]) for lang in langs}
+    names_indexes = {lang: build_proper_names_index(df_proper_names[lang]) for lang in langs}
+    vocab_indexes = {lang: {} for lang in langs}
+
+    for row_idx, curr_rows in aligned_rows:
+
+        for curr_row in curr_rows.values():
+            validate_template(curr_row)
+
+        # (rows are only skipped because of the columns shared by all the languages, e.g. proper names, so they are skipped in all of them)
+        row_configs = {lang: get_row_config(curr_category, curr_rows[lang], df_vocabs[lang], vocab_indexes[lang], args) for lang in langs}
+        if any(row_config is None for row_config in row_configs.values()):
+            continue
+
+        # the pairs of names of each language are listed first to check that they can be aligned before generating any instance of the row
+        name_pairs = {lang: list(iter_name_pairs(curr_category, curr_rows[lang], row_configs[lang], df_vocabs[lang], full_vocab_indexes[lang], df_proper_names[lang], args)) for lang in langs}
+        num_options = {lang: (len(name_pairs[lang]), len(row_configs[lang]["lex_div_combinations"])) for lang in langs}
+
+        if len(set(num_options.values())) > 1:
+            curr_row = curr_rows[langs[0]]
+            counts = ", ".join(f"{num_name_pairs} pairs of names and {num_lex_div} lexical diversity combinations in `{lang}`" for lang, (num_name_pairs, num_lex_div) in num_options.items())
+            print(f"[{curr_category}] WARNING: Skipping the instances of template {curr_row.esbbq_template_id}{curr_row.version} (flipped: {curr_row.flipped}) because its options don't match across languages ({counts}).")
+            continue
 
-            # generate all the possible combinations of WORD1, WORD2, ..., WORD<N>
-            lex_div_combinations: list = get_lex_div_combinations(grouped_lex_div_dict)
+        compiled_templates = {lang: compile_template(curr_rows[lang]) for lang in langs}
+
+        for aligned_name_pairs in zip(*name_pairs.values()):
+            for aligned_lex_divs in zip(*(row_configs[lang]["lex_div_combinations"] for lang in langs)):
+                # fill the template of each language with the same options, which generate the same instances in the same order
+                aligned_instances = [fill_instances(lang, curr_rows[lang], row_configs[lang], name_pair, lex_div, names_indexes[lang], compiled_templates[lang], profiler) for lang, name_pair, lex_div in zip(langs, aligned_name_pairs, aligned_lex_divs)]
+                for instances in zip(*aligned_instances):
+                    yield row_idx, dict(zip(langs, instances))
+
+def count_original_instances(instances: Iterator[tuple[int, dict[str, dict]]], row_counts: Counter) -> Iterator[tuple[int, dict[str, dict]]]:
+    """
+    Passes the instances generated from the template rows through, counting the ones generated by the original permutation of each row (before deduplication).
+    The permutations skipped by `get_all_permutations` (or `get_aligned_permutations`) would have generated the same number of instances each, so this measures the duplicates that were avoided.
+    """
+    for row_idx, aligned_instances in instances:
+        if next(iter(aligned_instances.values()))["flipped"] == "original":
+            row_counts[row_idx] += 1
+        yield row_idx, aligned_instances
+
+# columns with the texts that identify each of the four instances generated from a filled template (see `deduplicate_instances`), in the order in which `utils.generate_instances` yields them:
+# negative and non-negative questions, crossed with the ambiguous context or both contexts
+instance_key_columns = [
+    ("ambiguous_context", "question_negative_stereotype"),
+    ("ambiguous_context", "disambiguating_context", "question_negative_stereotype"),
+    ("ambiguous_context", "question_non_negative"),
+    ("ambiguous_context", "disambiguating_context", "question_non_negative"),
+]
+
+def get_instance_spaces(curr_category: str, template_rows: list[tuple[int, TemplateRow]], lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace) -> tuple[dict, list[dict]]:
+    """
+    Describes the distinct instances that a category generates without filling any text, as one space per permutation of each template row and instance of the four generated from each filled template (see `instance_key_columns`).
+    The context and question of an instance only depend on the values of the variables that occur in them, so the distinct instances of a space are the distinct values of its NAME variables (over the pairs of NAME1 and NAME2 of the row, following the rules of each category) times the distinct values of its WORD variables (over the lexical diversity options of each WORD label, which are crossed with each other).
+    Variables that only occur in the answers don't multiply the instances, and instances with the same texts in several permutations or rows of the same template are only kept in the first one, as they are deduplicated in the generation.
+    Each distinct value is represented by the first pair of names or lexical diversity option that produces it, which is the one whose instance is kept in the generation.
+
+    Args:
+        curr_category (str): The category of the templates.
+        template_rows (list[tuple[int, TemplateRow]]): The template rows of the category (with all their permutations, if any), each with the index of the original row in the spreadsheet.
+
+    Returns:
+        tuple[dict, list[dict]]: The configuration (see `get_row_config`) and the pairs of NAME1 and NAME2 (see `iter_name_pairs`) of each row, and the spaces of instances.
+        Each space has the position of the permuted row in `template_rows`, its template (template_id and version), the index of the instance in the filled template, the indexes of the pairs of names with distinct values, the indexes of the lexical diversity options with distinct values of each WORD label, and the number of instances.
+    """
+
+    full_vocab_index = build_vocab_index(df_vocab)
+    names_index = build_proper_names_index(df_proper_names)
+    vocab_indexes = {}
+
+    # configuration and pairs of NAME1 and NAME2 of each row, shared by all of its permutations
+    row_options = {}
+
+    # values of the NAME variables already used for each template, texts and values of the WORD variables
+    seen_name_values = {}
+
+    spaces = []
+
+    for position, (row_idx, curr_row) in enumerate(template_rows):
 
+        validate_template(curr_row)
+
+        if row_idx not in row_options:
+            row_config = get_row_config(curr_category, curr_row, df_vocab, vocab_indexes, args)
+            name_pairs = [] if row_config is None else list(iter_name_pairs(curr_category, curr_row, row_config, df_vocab, full_vocab_index, df_proper_names, args))
+            row_options[row_idx] = (row_config, name_pairs)
+
+        row_config, name_pairs = row_options[row_idx]
+        if row_config is None:
+            continue
+
+        # the spaces index the product of all the options of the WORD variables, which doesn't hold if some of their combinations are left out
+        if row_config["lex_div_capped"]:
+            raise Exception(f"Template {curr_row.esbbq_template_id}{curr_row.version} of {curr_category} has more combinations of lexical diversity than --max-lex-div-combinations, so its instances can't be counted or sampled. Raise the limit or set it to 0 to remove it.")
+
+        template_id = curr_row.esbbq_template_id
+        compiled_template = compile_template(curr_row)
+        lex_div_dict = row_config["grouped_lex_div_dict"]
+
+        def resolve(slot: tuple, name1: str = None, name2: str = None, lex_div_assignment: dict = None) -> str:
+            return resolve_variable(lang, curr_row, *slot, name1, name2, row_config["grouped_names_dict"], lex_div_dict, lex_div_assignment, row_config["stated_gender"], row_config["vocab_index"], row_config["proper_names_only"], names_index)
+
+        for instance_idx, key_columns in enumerate(instance_key_columns):
+            # the literal segments of the texts, and their slots, split into NAME and WORD variables
+            literals = tuple(tuple(compiled_template[column][0::2]) for column in key_columns)
+            slots = [slot for column in key_columns for slot in compiled_template[column][1::2]]
+            name_slots = [slot for slot in slots if slot[1].startswith("NAME")]
+            word_slots = [slot for slot in slots if not slot[1].startswith("NAME")]
+
+            # distinct values of the NAME variables over the pairs of NAME1 and NAME2 (with the first pair that produces each of them)
+            name_values = {}
+            for pair_idx, (name1, name2, _, _) in enumerate(name_pairs):
+                name_values.setdefault(tuple(resolve(slot, name1=name1, name2=name2) for slot in name_slots), pair_idx)
+
+            # distinct values of the WORD variables of each label over its options (only the first one in minimal mode), with the first option that produces each of them
+            word_options = []
+            word_values = []
+            for label in dict.fromkeys(slot[1] for slot in word_slots):
+                num_options = 1 if args.minimal else len(next(iter(lex_div_dict[label].values())))
+                label_slots = [slot for slot in word_slots if slot[1] == label]
+                label_values = {}
+                for option_idx in range(num_options):
+                    label_values.setdefault(tuple(resolve(slot, lex_div_assignment={label: option_idx}) for slot in label_slots), option_idx)
+                word_options.append((label, list(label_values.values())))
+                word_values.append(frozenset(label_values))
+
+            if args.minimal:
+                # instances are not deduplicated in minimal mode
+                pair_indexes = list(range(len(name_pairs)))
+            else:
+                seen = seen_name_values.setdefault((template_id, literals, tuple(word_values)), set())
+                pair_indexes = [pair_idx for values, pair_idx in name_values.items() if values not in seen]
+                seen.update(name_values)
+
+            size = len(pair_indexes)
+            for _, options in word_options:
+                size *= len(options)
+
+            spaces.append({
+                "position": position,
+                "template": (template_id, curr_row.version),
+                "instance_idx": instance_idx,
+                "pair_indexes": pair_indexes,
+                "word_options": word_options,
+                "size": size,
+            })
+
+    return row_options, spaces
+
+def count_category_instances(curr_category: str, template_rows: list[tuple[int, TemplateRow]], lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace) -> Counter:
+    """
+    Computes the number of instances that each template of a category generates, combinatorially and without filling any text (see `--count-only` and `get_instance_spaces`).
+
+    Args:
+        curr_category (str): The category of the templates.
+        template_rows (list[tuple[int, TemplateRow]]): The template rows of the category (with all their permutations, if any), each with the index of the original row in the spreadsheet.
+
+    Returns:
+        Counter: The number of instances of each template, indexed by template_id and version.
+    """
+
+    _, spaces = get_instance_spaces(curr_category, template_rows, lang, df_vocab, df_proper_names, args)
+
+    template_counts = Counter()
+    for space in spaces:
+        template_counts[space["template"]] += space["size"]
+
+    return template_counts
+
+# strategies to draw the instances in sampling mode (see `--sample`)
+sample_strategies = ["uniform", "stratified"]
+
+def get_stereotyped_group(name1_info: str, name2_info: str, bias_targets: list[str]) -> str:
+    """
+    Returns the stereotyped group that an instance refers to, i.e. the first bias target found in the information of NAME1 or, otherwise, of NAME2 (like in `utils.generate_instances`).
+    """
+    for name_info in (name1_info, name2_info):
+        for info in split_and_strip(name_info, ","):
+            if info in bias_targets:
+                return info
+    return ""
+
+def allocate_sample(sizes: list[int], sample_size: int) -> list[int]:
+    """
+    Splits a sample as evenly as possible among groups of the given sizes. Groups smaller than their share are taken whole and the rest of their share goes to the other groups.
+
+    Args:
+        sizes (list[int]): The number of elements of each group.
+        sample_size (int): The number of elements to sample in total.
+
+    Returns:
+        list[int]: The number of elements to sample from each group.
+    """
+    quotas = [0] * len(sizes)
+    remaining = sample_size
+    open_groups = [group_idx for group_idx, size in enumerate(sizes) if size > 0]
+
+    while remaining > 0 and open_groups:
+        share, extra = divmod(remaining, len(open_groups))
+        for position, group_idx in enumerate(open_groups):
+            quota = min(share + (position < extra), sizes[group_idx] - quotas[group_idx])
+            quotas[group_idx] += quota
+            remaining -= quota
+        open_groups = [group_idx for group_idx in open_groups if quotas[group_idx] < sizes[group_idx]]
+
+    return quotas
+
+def is_sampling(args: argparse.Namespace) -> bool:
+    """
+    Returns whether only a sample of the instances is generated (see `--sample` and `--sample-budget`).
+    """
+    return args.sample is not None or args.sample_budget is not None
+
+def get_category_sample_budget(curr_category: str, args: argparse.Namespace) -> int:
+    """
+    Returns the part of the global sample budget (see `--sample-budget`) that corresponds to a category: the budget is split evenly among the categories generated.
+    """
+    share, extra = divmod(args.sample_budget, len(args.categories))
+    return share + (args.categories.index(curr_category) < extra)
+
+def sample_category_instances(curr_category: str, template_rows: list[tuple[int, TemplateRow]], lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace, profiler: Profiler) -> Iterator[tuple[int, dict]]:
+    """
+    Generates a random sample of the instances of a category, only filling the templates with the combinations drawn (see `--sample` and `--sample-budget`).
+    The distinct instances of each template are indexed by position in the product of the pairs of NAME1 and NAME2, the lexical diversity options and the permutations (flipped) of its rows (see `get_instance_spaces`), so an instance can be drawn by its index alone, without enumerating the product, and no instance drawn is a duplicate.
+    Instances are drawn without replacement, either uniformly from each template (or from the whole category, with a global budget) or evenly from each stratum, i.e. each stereotyped group and permutation of each template.
+    The random generator is seeded with `--seed` and the category, so the same instances are drawn in every run and in every language.
+
+    Args:
+        curr_category (str): The category of the templates.
+        template_rows (list[tuple[int, TemplateRow]]): The template rows of the category (with all their permutations, if any), each with the index of the original row in the spreadsheet.
+        profiler (Profiler): Profiler of the category, which measures the time spent filling the templates and assembling the instances of each template.
+
+    Yields:
+        tuple[int, dict]: The index of the template row that generated the instance and the instance itself (without ID).
+    """
+
+    row_options, spaces = get_instance_spaces(curr_category, template_rows, lang, df_vocab, df_proper_names, args)
+    names_index = build_proper_names_index(df_proper_names)
+
+    if args.sample_strategy == "stratified":
+        # split each space by the stereotyped group of its pairs of names
+        stratified_spaces = []
+        for space in spaces:
+            row_idx, curr_row = template_rows[space["position"]]
+            row_config, name_pairs = row_options[row_idx]
+
+            pairs_per_group = {}
+            for pair_idx in space["pair_indexes"]:
+                _, _, name1_info, name2_info = name_pairs[pair_idx]
+                pairs_per_group.setdefault(get_stereotyped_group(name1_info, name2_info, row_config["bias_targets"]), []).append(pair_idx)
+
+            for group, pair_indexes in pairs_per_group.items():
+                stratified_spaces.append({**space, "stratum": (group, curr_row.flipped), "pair_indexes": pair_indexes, "size": space["size"] // len(space["pair_indexes"]) * len(pair_indexes)})
+        spaces = stratified_spaces
+
+    # group the spaces to sample from
+    sample_groups = {}
+    for space in spaces:
+        if args.sample_strategy == "stratified":
+            group_key = (space["template"], space["stratum"])
+        elif args.sample_budget is None:
+            group_key = space["template"]
         else:
-            # if there is no lexical diversity, create a list with one combination set to None so that we can still loop over the "combinations" and only generate one
-            lex_div_combinations = [None]
-            grouped_lex_div_dict = {}
+            group_key = None
+        sample_groups.setdefault(group_key, []).append(space)
 
-        if args.minimal:
-            lex_div_combinations = lex_div_combinations[:1]
+    group_sizes = [sum(space["size"] for space in group_spaces) for group_spaces in sample_groups.values()]
+
+    # decide how many instances to draw from each group
+    if args.sample_budget is not None:
+        quotas = allocate_sample(group_sizes, get_category_sample_budget(curr_category, args))
+    else:
+        # split the sample of each template among its groups (there is only one per template, unless stratifying)
+        group_templates = [group_spaces[0]["template"] for group_spaces in sample_groups.values()]
+        quotas = [0] * len(sample_groups)
+        for template in dict.fromkeys(group_templates):
+            template_groups = [group_idx for group_idx, group_template in enumerate(group_templates) if group_template == template]
+            for group_idx, quota in zip(template_groups, allocate_sample([group_sizes[group_idx] for group_idx in template_groups], args.sample)):
+                quotas[group_idx] = quota
+
+    print(f"[{curr_category}] Sampling {sum(quotas)} out of {sum(group_sizes)} instances in `{lang}` ({args.sample_strategy}).")
+
+    # draw the indexes of the instances of each group and find the pair of names and lexical diversity options that generate each of them
+    rng = random.Random(f"{args.seed}|{curr_category}")
+    sampled = {}
+    for group_spaces, group_size, quota in zip(sample_groups.values(), group_sizes, quotas):
+        space_ends = list(itertools.accumulate(space["size"] for space in group_spaces))
+
+        for index in rng.sample(range(group_size), quota):
+            space_position = bisect.bisect_right(space_ends, index)
+            space = group_spaces[space_position]
+            index -= space_ends[space_position] - space["size"]
+
+            # the index of the instance in the space is a mixed-radix number: pair of names first and then the option of each WORD label
+            lex_div_assignment = {}
+            for label, options in reversed(space["word_options"]):
+                index, option_position = divmod(index, len(options))
+                lex_div_assignment[label] = options[option_position]
+            pair_idx = space["pair_indexes"][index]
+
+            # the labels whose values don't change the instance take their first option
+            row_config, _ = row_options[template_rows[space["position"]][0]]
+            lex_div_assignment = {label: lex_div_assignment.get(label, 0) for label in row_config["grouped_lex_div_dict"]} or None
+
+            lex_div_key = tuple(lex_div_assignment.values()) if lex_div_assignment else ()
+            sampled.setdefault((space["position"], pair_idx, lex_div_key), (lex_div_assignment, set()))[1].add(space["instance_idx"])
+
+    # fill only the combinations drawn, in the same order as in the full generation
+    compiled_templates = {}
+    for (position, pair_idx, _), (lex_div_assignment, instance_indexes) in sorted(sampled.items(), key=lambda item: item[0]):
+        row_idx, curr_row = template_rows[position]
+        row_config, name_pairs = row_options[row_idx]
+
+        if position not in compiled_templates:
+            compiled_templates[position] = compile_template(curr_row)
+
+        for instance_idx, instance in enumerate(fill_instances(lang, curr_row, row_config, name_pairs[pair_idx], lex_div_assignment, names_index, compiled_templates[position], profiler)):
+            if instance_idx in instance_indexes:
+                yield row_idx, instance
+
+# folder of each language where the instances generated by each shard are saved until they are merged (see `--shard` and `--merge-shards`)
+shards_dir = "shards"
+
+def get_shard_fn(output_fn_prefix: str, shard: int, num_shards: int) -> str:
+    """
+    Returns the path of the file with the instances generated by a shard, next to the output files (e.g. `data_es/shards/Age.full.shard-0-of-4.jsonl`).
+    """
+    output_dir, output_prefix = os.path.split(output_fn_prefix)
+    return os.path.join(output_dir, shards_dir, f"{output_prefix}shard-{shard}-of-{num_shards}.jsonl")
+
+def get_shard(curr_category: str, row_idx: int, name1_idx: int, num_shards: int) -> int:
+    """
+    Returns the shard that generates the instances of a template row with one of its values of NAME1 (by position in the options of NAME1, which is the same in all the languages).
+    It only depends on its arguments (not on the machine or the run), so independent machines agree on the split without sharing any state.
+    """
+    unit_hash = hashlib.sha256(f"{curr_category}|{row_idx}|{name1_idx}".encode("utf-8")).digest()
+    return int.from_bytes(unit_hash[:8], "big") % num_shards
+
+def generate_shard_instances(curr_category: str, template_rows: list[tuple[int, TemplateRow]], lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, args: argparse.Namespace, profiler: Profiler) -> Iterator[tuple[tuple[int, int], int, dict]]:
+    """
+    Generates the instances of the current shard (see `--shard`): those of the template rows and values of NAME1 assigned to it by `get_shard`, in the same order as in a run on a single node.
+    Each instance comes with the position of its unit of work (the permutation of the row and the position of NAME1), so that the instances of all the shards can be put back in order when merging them (see `merge_shard_instances`).
+
+    Args:
+        curr_category (str): The category of the templates.
+        template_rows (list[tuple[int, TemplateRow]]): The template rows of the category (with all their permutations, if any), each with the index of the original row in the spreadsheet.
+        profiler (Profiler): Profiler of the category, which measures the time spent filling the templates and assembling the instances of each template.
+
+    Yields:
+        tuple[tuple[int, int], int, dict]: The position of the permuted row and of NAME1, the index of the template row that generated the instance and the instance itself (without ID).
+    """
+
+    full_vocab_index = build_vocab_index(df_vocab)
+    names_index = build_proper_names_index(df_proper_names)
+    vocab_indexes = {}
+
+    for position, (row_idx, curr_row) in enumerate(template_rows):
+
+        validate_template(curr_row)
+
+        row_config = get_row_config(curr_category, curr_row, df_vocab, vocab_indexes, args)
+        if row_config is None:
+            continue
+
+        compiled_template = compile_template(curr_row)
+
+        # group the pairs of names by NAME1, and only fill the ones of the current shard
+        name_pairs = iter_name_pairs(curr_category, curr_row, row_config, df_vocab, full_vocab_index, df_proper_names, args)
+        for name1_idx, (_, name1_pairs) in enumerate(itertools.groupby(name_pairs, key=lambda name_pair: name_pair[0])):
+            if get_shard(curr_category, row_idx, name1_idx, args.num_shards) != args.shard:
+                continue
+
+            for name_pair in name1_pairs:
+                for curr_lex_div in row_config["lex_div_combinations"]:
+                    for instance in fill_instances(lang, curr_row, row_config, name_pair, curr_lex_div, names_index, compiled_template, profiler):
+                        yield (position, name1_idx), row_idx, instance
+
+def read_shard_instances(shard_fn: str) -> Iterator[tuple[tuple[int, int], int, dict]]:
+    """
+    Reads the instances saved by a shard, with the position of their unit of work and the index of their template row (see `generate_shard_instances`).
+    """
+    with open(shard_fn) as shard_file:
+        for line in shard_file:
+            record = json.loads(line)
+            yield tuple(record["unit"]), record["row_idx"], record["instance"]
+
+def merge_shard_instances(output_fn_prefix: str, lang: str, num_shards: int) -> Iterator[tuple[int, dict[str, dict]]]:
+    """
+    Merges the instances saved by all the shards of a category into a single stream, in the same order as in a run on a single node.
+    Each shard saves its instances in order, so the shards are merged lazily, reading one instance of each at a time.
+
+    Args:
+        output_fn_prefix (str): Prefix of the output files of the category (e.g. `data_es/Age.full.`).
+        num_shards (int): Number of shards into which the generation was split.
+
+    Yields:
+        tuple[int, dict[str, dict]]: The index of the template row that generated the instance and the instance of the language.
+    """
+
+    shard_fns = [get_shard_fn(output_fn_prefix, shard, num_shards) for shard in range(num_shards)]
+    missing_shard_fns = [shard_fn for shard_fn in shard_fns if not os.path.exists(shard_fn)]
+    assert not missing_shard_fns, f"Missing the instances of some shards: {', '.join(missing_shard_fns)}"
+
+    for _, row_idx, instance in heapq.merge(*[read_shard_instances(shard_fn) for shard_fn in shard_fns], key=lambda record: record[0]):
+        yield row_idx, {lang: instance}
+
+# fields that must be equal in the instances of all the languages for them to be aligned (see `align_instances`)
+alignment_fields = ["template_id", "version", "flipped", "question_polarity", "context_condition", "question_type", "label"]
+
+def align_instances(curr_category: str, instance_streams: dict[str, Iterator[tuple[int, dict]]], row_indexes: list[int]) -> Iterator[tuple[int, dict[str, dict]]]:
+    """
+    Traverses the instance streams of several languages at the same time, so that the instances generated from the same template row, permutation, names, lexical diversity combination, context and question in every language come out together.
+    It's used to align the samples drawn separately in each language (the full generation fills all the languages in a single traversal instead, see `generate_aligned_instances`). The instances of the rows and permutations whose number or labels differ between languages can't be aligned, so they are skipped in all the languages with a warning.
+
+    Args:
+        curr_category (str): The category of the templates.
+        instance_streams (dict[str, Iterator[tuple[int, dict]]]): The (row index, instance) pairs generated for each language (see `generate_category_instances`).
+        row_indexes (list[int]): The indexes of the template rows, in the order in which they are generated.
+
+    Yields:
+        tuple[int, dict[str, dict]]: The index of the template row that generated the instances and the instance of each language.
+    """
+
+    langs = list(instance_streams)
+
+    # group the instances of each language by template row
+    grouped_streams = {lang: itertools.groupby(stream, key=lambda item: item[0]) for lang, stream in instance_streams.items()}
+    next_groups = {lang: next(grouped_streams[lang], (None, None)) for lang in langs}
+
+    for row_idx in row_indexes:
+
+        # get the instances of the row in each language, grouped by permutation (a row may have no instances at all, e.g. if it's skipped)
+        row_instances = {}
+        for lang in langs:
+            group_row_idx, group = next_groups[lang]
+            row_instances[lang] = {}
+            if group_row_idx == row_idx:
+                for _, instance in group:
+                    row_instances[lang].setdefault(instance["flipped"], []).append(instance)
+                next_groups[lang] = next(grouped_streams[lang], (None, None))
+
+        for flipped in dict.fromkeys(flipped for lang in langs for flipped in row_instances[lang]):
+            permutation_instances = [row_instances[lang].get(flipped, []) for lang in langs]
+            permutation_structures = [[tuple(instance[field] for field in alignment_fields) for instance in instances] for instances in permutation_instances]
+
+            if any(structure != permutation_structures[0] for structure in permutation_structures):
+                instance = next(instance for instances in permutation_instances for instance in instances)
+                counts = ", ".join(f"{len(instances)} in `{lang}`" for lang, instances in zip(langs, permutation_instances))
+                print(f"[{curr_category}] WARNING: Skipping the instances of template {instance['template_id']}{instance['version']} (flipped: {flipped}) because their number or labels don't match across languages ({counts}).")
+                continue
+
+            for aligned_instances in zip(*permutation_instances):
+                yield row_idx, dict(zip(langs, aligned_instances))
+
+def print_profile(name: str, profiler: Profiler, total_time: float) -> None:
+    """
+    Prints the time and memory of each stage of a profiled run, along with the time spent outside every stage (e.g. preparing the rows and pairing the names), so that the times add up to the total.
+
+    Args:
+        name (str): The name of the profiled run (a category, or `vocabulary` for the vocabulary files read by the generator).
+        profiler (Profiler): The profiler of the run, already stopped.
+        total_time (float): The total wall time (in seconds) of the run.
+    """
+    from tabulate import tabulate
+
+    print(f"[{name}] Profile (total: {round(total_time, 2)}s):")
+    # (the missing calls and memory of the time outside every stage are printed empty)
+    df_stage_stats = profiler.get_stage_stats(total_time).astype(object)
+    df_stage_stats = df_stage_stats.where(df_stage_stats.notna(), None)
+    print(tabulate(df_stage_stats, headers=["stage", "calls", "time (s)", "peak memory (MB)"], tablefmt="psql"))
+
+def deduplicate_instances(instances: Iterable[tuple[int, dict[str, dict]]], profiler: Profiler) -> Iterator[tuple[int, dict[str, dict]]]:
+    """
+    Filters a stream of (row index, instance of each language) pairs to keep only the first instance with each combination of template ID, context and question.
+    When generating several languages, instances are dropped in all of them as soon as they are duplicates in any language, so that they stay aligned.
+    Only a 16-byte hash of each combination is kept in memory instead of the texts.
+    """
+
+    # Set to track the unique combinations of relevant columns of each language
+    seen = {}
+    for row_idx, aligned_instances in instances:
+        with profiler.stage("dedup"):
+            identifiers = {lang: hashlib.blake2b(f"{instance['template_id']}\0{instance['context']}\0{instance['question']}".encode("utf-8"), digest_size=16).digest() for lang, instance in aligned_instances.items()}
+            is_duplicate = any(identifier in seen.setdefault(lang, set()) for lang, identifier in identifiers.items())
+            if not is_duplicate:
+                for lang, identifier in identifiers.items():
+                    seen[lang].add(identifier)
+
+        if not is_duplicate:
+            yield row_idx, aligned_instances
+
+def generate_category(curr_category: str, langs: list[str], df_vocabs: dict[str, pd.DataFrame], df_proper_names: dict[str, pd.DataFrame], args: argparse.Namespace) -> dict:
+    """
+    Reads the templates of one category, generates all of its instances in each of the given languages and saves them to the output files.
+    With several languages, the spreadsheet is only read once and the instances of all the languages are generated in a single traversal (see `generate_aligned_instances`), aligned by `instance_id` and saved to `data_<language>/<category>.<suffix>.aligned.<format>`, so that the datasets of each language alone are never replaced by them.
+    It only depends on its arguments, so that it can be run on its own worker process (see `--workers`).
+
+    Returns:
+        dict: The statistics of the category (number of templates and rows, total instances and avg. fertility).
+    """
+
+    import pandas as pd
+
+    # initialize dict for the statistics of this category
+    category_stats = {}
+
+    # measure the time and memory of each stage of the generation, if profiling
+    profiler = Profiler(enabled=args.profile)
+    profiler.start()
+    start_time = time.perf_counter()
+
+    # read the category's Excel spreadsheet of templates (or its cached version)
+    with profiler.stage("load"):
+        df_categories = read_spreadsheet_cached(os.path.join(args.templates_dir, f"{curr_category}.xlsx"), langs, read_category_spreadsheet, use_cache=not args.no_cache, cache_dir=args.cache_dir)
+
+    # (the rows are the same in all the languages, only their texts change)
+    df_category = df_categories[langs[0]]
+
+    print(f"[{curr_category}] Imported {len(df_category)} templates.")
+
+    if args.minimal:
+        output_suffix = "minimal"
+    elif is_sampling(args):
+        output_suffix = "sample"
+    else:
+        output_suffix = "full"
+
+    # the instances generated along with other languages (and their statistics) are saved apart, as the rows that can't be aligned are skipped and the duplicates in any language are dropped in all of them
+    # (the datasets of each language are generated with that language alone)
+    aligned_suffix = ".aligned" if len(langs) > 1 else ""
+    output_fn_prefixes = {lang: os.path.join(get_data_dir(lang, args), f"{curr_category}.{output_suffix}{aligned_suffix}.") for lang in langs}
+
+    # hash each template row to find the ones that changed since the previous run
+    with profiler.stage("hash"):
+        row_hashes = {lang: get_template_row_hashes(df_categories[lang], curr_category, lang, df_vocabs[lang], df_proper_names[lang], args) for lang in langs}
+    hashes_fns = {lang: os.path.join(args.cache_dir, incremental_cache_dir, f"data_{lang}", f"{curr_category}.{output_suffix}{aligned_suffix}.hashes.json") for lang in langs}
+
+    # get the instances that can be reused from the previous run, if running in incremental mode (only available for one language at a time)
+    reusable_instances = {lang: {} for lang in langs}
+    if args.incremental:
+        for lang in langs:
+            with profiler.stage("reuse"):
+                reusable_instances[lang] = load_reusable_instances(hashes_fns[lang], output_fn_prefixes[lang] + "jsonl", df_categories[lang], row_hashes[lang])
+            num_regenerated_templates = len(set(df_category.esbbq_template_id[~df_category.index.isin(reusable_instances[lang].keys())]))
+            print(f"[{curr_category}] Incremental mode: regenerating {num_regenerated_templates} out of {len(set(df_category.esbbq_template_id))} templates.")
+
+    # rows reused from the previous run (`generate_category_instances` empties `reusable_instances` as it splices them in)
+    reused_rows = {lang: set(reusable_instances[lang]) for lang in langs}
+
+    # save the number of templates in stats
+    category_stats["num_templates"] = len(set(df_category.esbbq_template_id))
+    category_stats["num_rows"] = len(df_category)
+
+    # chain the stages of the generation of each language, through which the instances go one at a time
+    instance_streams = {}
+
+    # permutations of each row skipped because they would only generate duplicates, and instances generated by the original permutation of each row (to report the duplicates avoided)
+    skipped_permutations = Counter()
+    original_instances = None
+
+    # convert the rows to a lightweight representation (pandas is not used any more until the instances are written)
+    all_template_rows = {lang: [(row_idx, TemplateRow.from_dict(row)) for row_idx, row in zip(df_categories[lang].index, df_categories[lang].to_dict("records"))] for lang in langs}
+
+    if len(langs) > 1 and not is_sampling(args):
+        # fill the templates of all the languages in a single traversal, with the same permutations, so that their instances are aligned by construction
+        aligned_rows = [(row_idx, {lang: all_template_rows[lang][position][1] for lang in langs}) for position, (row_idx, _) in enumerate(all_template_rows[langs[0]])]
+
+        if not args.minimal:
+            with profiler.stage("permutation"):
+                aligned_rows, skipped_permutations = get_aligned_permutations(aligned_rows)
+            print(f"[{curr_category}] Skipped {sum(skipped_permutations.values())} permutations of NAME1 and NAME2 that would only generate duplicates.")
+
+        original_instances = Counter()
+        instances = count_original_instances(generate_aligned_instances(curr_category, aligned_rows, df_vocabs, df_proper_names, args, profiler), original_instances)
+
+    else:
+        for lang in langs:
+            template_rows = all_template_rows[lang]
+
+            # generate all possible templates with permutations of NAME1 and NAME2
+            if not args.minimal:
+                with profiler.stage("permutation"):
+                    template_rows, skipped_permutations = get_all_permutations(template_rows)
+                print(f"[{curr_category}] Skipped {sum(skipped_permutations.values())} permutations of NAME1 and NAME2 that would only generate duplicates.")
+
+            if args.count_only:
+                # count the instances of each template (indexed by template_id and version) instead of generating them (only available for one language at a time)
+                with profiler.stage("count"):
+                    template_counts = count_category_instances(curr_category, template_rows, lang, df_vocabs[lang], df_proper_names[lang], args)
+            elif args.merge_shards:
+                # the instances are read from the files of the shards instead (see `merge_shard_instances`)
+                pass
+            elif args.shard is not None:
+                instance_streams[lang] = generate_shard_instances(curr_category, template_rows, lang, df_vocabs[lang], df_proper_names[lang], args, profiler)
+            elif is_sampling(args):
+                instance_streams[lang] = sample_category_instances(curr_category, template_rows, lang, df_vocabs[lang], df_proper_names[lang], args, profiler)
+            else:
+                original_instances = Counter()
+                instances = ((row_idx, {lang: instance}) for row_idx, instance in generate_category_instances(curr_category, template_rows, lang, df_vocabs[lang], df_proper_names[lang], args, reusable_instances[lang], profiler))
+                instances = count_original_instances(instances, original_instances)
+
+    if args.count_only:
+        total_instances = sum(template_counts.values())
+        writers = {lang: {} for lang in langs}
+        print(f"[{curr_category}] Counted {total_instances} sentences total (without generating them).")
+
+    elif args.shard is not None:
+        # save the instances of the shard in order, along with the position of their unit of work, to merge them later (only available for one language at a time)
+        lang = langs[0]
+        shard_instances = (((unit, row_idx), {lang: instance}) for unit, row_idx, instance in instance_streams[lang])
+
+        # instances can already be deduplicated within the shard, as the first of each set of duplicates across all the shards is never after any of them
+        if not args.minimal:
+            shard_instances = deduplicate_instances(shard_instances, profiler)
+
+        template_counts = Counter()
+        total_instances = 0
+
+        shard_fn = get_shard_fn(output_fn_prefixes[lang], args.shard, args.num_shards)
+        os.makedirs(os.path.dirname(shard_fn), exist_ok=True)
+
+        # write to a temporary file first so that the merge never reads a half-written shard
+        tmp_fn = f"{shard_fn}.{os.getpid()}.tmp"
+        with open(tmp_fn, "w") as shard_file:
+            for (unit, row_idx), aligned_instances in shard_instances:
+                instance = aligned_instances[lang]
+                shard_file.write(json.dumps({"unit": unit, "row_idx": row_idx, "instance": instance}, default=str, ensure_ascii=False) + "\n")
+                template_counts[(instance["template_id"], instance["version"])] += 1
+                total_instances += 1
+        os.replace(tmp_fn, shard_fn)
+
+        writers = {lang: {} for lang in langs}
+        print(f"[{curr_category}] Generated {total_instances} sentences in shard {args.shard} of {args.num_shards}, saved to `{shard_fn}`.")
 
+    else:
+        if args.merge_shards:
+            # read the instances of all the shards back in the order of a run on a single node (only available for one language at a time)
+            instances = merge_shard_instances(output_fn_prefixes[langs[0]], langs[0], args.num_shards)
+        elif is_sampling(args) and len(langs) > 1:
+            # the samples of each language are drawn separately, so they are traversed together to align them
+            instances = align_instances(curr_category, instance_streams, list(df_category.index))
+        elif is_sampling(args):
+            instances = ((row_idx, {langs[0]: instance}) for row_idx, instance in instance_streams[langs[0]])
+
+        # Generating all possible permutations of NAME1 and NAME2 creates duplicates. Deduplicate instances before saving them
+        if not args.minimal:
+            instances = deduplicate_instances(instances, profiler)
+
+        # count the instances of each template (indexed by template_id and version) for fertility stats, and of each row for the incremental mode
+        template_counts = Counter()
+        instances_per_row = Counter()
+        total_instances = 0
+
+        output_formats = [] if args.dry_run else args.output_formats
+        if output_formats:
+            for lang in langs:
+                os.makedirs(get_data_dir(lang, args), exist_ok=True)
+
+        with ExitStack() as stack:
+            writers = {lang: {output_format: stack.enter_context(instance_writers[output_format](output_fn_prefixes[lang] + output_format)) for output_format in output_formats} for lang in langs}
+
+            for instance_id, (row_idx, aligned_instances) in enumerate(instances):
+                for lang, instance_dict in aligned_instances.items():
+                    # add sequential IDs to each instance dict (the same ID in all the languages)
+                    instance = {"instance_id": instance_id, **instance_dict}
+
+                    for output_format, writer in writers[lang].items():
+                        with profiler.stage(f"write_{output_format}"):
+                            writer.write(instance)
+
+                template_counts[(instance["template_id"], instance["version"])] += 1
+                instances_per_row[row_idx] += 1
+                total_instances += 1
+
+            # (the writers only replace the output files if no exception is raised)
+            assert total_instances, f"No instances generated for {curr_category}!"
+
+        print(f"[{curr_category}] Generated {total_instances} sentences total.")
+
+        # each skipped permutation would have generated as many instances as the original permutation of its row (the rows reused from the previous run were not generated again)
+        if original_instances is not None:
+            for lang in langs:
+                num_avoided = sum(num_skipped * original_instances[row_idx] for row_idx, num_skipped in skipped_permutations.items() if row_idx not in reused_rows[lang])
+                print(f"[{curr_category}] Avoided generating {num_avoided} duplicate instances in `{lang}` by skipping {sum(skipped_permutations.values())} permutations of NAME1 and NAME2.")
+
+    for lang in langs:
+        for writer in writers[lang].values():
+            print(f"[{curr_category}] Instances saved to `{writer.output_fn}`.")
+
+    # calculate the fertility of each template (indexed by template_id and version) from the instance counts
+    df_category_fertility = pd.DataFrame([(template_id, version, count) for (template_id, version), count in template_counts.items()], columns=["template_id", "version", "instances"])
+    df_category_fertility = df_category_fertility.groupby(["template_id", "version"])["instances"].sum().reset_index()
+
+    # (the fertility of a shard only covers part of the instances, so it's saved when merging the shards)
+    if args.save_fertility and args.shard is None:
+        for lang in langs:
+            # save the fertility dict to a CSV under stats/template_fertility
+            os.makedirs(get_stats_dir(lang, args), exist_ok=True)
+            fertility_fn = os.path.join(get_stats_dir(lang, args), f"{curr_category}{aligned_suffix}.fertility.csv")
+            df_category_fertility.to_csv(fertility_fn, index=False)
+            print(f"[{curr_category}] Fertility saved to `{fertility_fn}`.")
+
+    # save stats
+    category_stats["total_instances"] = total_instances
+    category_stats["avg_fertility"] = round(df_category_fertility.instances.mean())
+
+    if args.profile:
+        profiler.stop()
+        total_time = time.perf_counter() - start_time
+        category_stats["time_s"] = round(total_time, 2)
+
+        print_profile(curr_category, profiler, total_time)
+
+        # save the time spent on each template next to its fertility
+        df_template_times = profiler.get_template_stats(template_counts)
+        for lang in langs:
+            os.makedirs(get_stats_dir(lang, args), exist_ok=True)
+            timing_fn = os.path.join(get_stats_dir(lang, args), f"{curr_category}{aligned_suffix}.timing.csv")
+            df_template_times.to_csv(timing_fn, index=False)
+            print(f"[{curr_category}] Template timing saved to `{timing_fn}`.")
+
+    for lang in langs:
+        if "jsonl" in writers[lang]:
+            # save the hash and the number of instances of each template row, so that the next run in incremental mode can reuse them
+            row_hash_info = zip(df_category.index, df_category.esbbq_template_id, df_category.version, row_hashes[lang])
+            os.makedirs(os.path.dirname(hashes_fns[lang]), exist_ok=True)
+            with open(hashes_fns[lang], "w") as hashes_file:
+                json.dump({
+                    "jsonl_sha256": writers[lang]["jsonl"].sha256,
+                    "rows": [{"template_id": template_id, "version": version, "hash": row_hash, "instances": instances_per_row[row_idx]} for row_idx, template_id, version, row_hash in row_hash_info],
+                }, hashes_file, default=str, ensure_ascii=False)
+
+    return category_stats
+
+def get_error_message(error: Exception) -> str:
+    """
+    Returns a readable message for an error found when linting the templates, including the type of error unless it's a failed check (assert).
+    """
+    if isinstance(error, AssertionError):
+        return str(error) or "Failed check."
+    return f"{type(error).__name__}: {error}"
+
+def lint_template_row(curr_category: str, row_idx: int, curr_row: TemplateRow, lang: str, df_vocab: pd.DataFrame, df_proper_names: pd.DataFrame, indexes: dict, args: argparse.Namespace) -> list[str]:
+    """
+    Checks a template row for all the errors that would stop the generation of its instances, without stopping at the first one: the checks of `validate_template`, the format of the variables and of the names and lexical diversity columns, the vocabulary of its subcategory, the options of NAME1 and NAME2, and filling it with the first pair of names and lexical diversity combination.
+
+    Args:
+        curr_category (str): The category of the template.
+        row_idx (int): The index of the row in the spreadsheet.
+        curr_row (TemplateRow): The template row.
+        indexes (dict): The index of the full vocabulary (`full_vocab_index`), of the proper names (`names_index`) and of the vocabulary of each subcategory of the category (`vocab_indexes`), shared by all the rows of the category.
+
+    Returns:
+        list[str]: The errors found in the row, if any.
+    """
+
+    errors = []
+
+    try:
+        validate_template(curr_row)
+    except Exception as e:
+        errors.append(get_error_message(e))
+
+    # the rest of the checks need the variables and the configuration of the row
+    try:
+        compiled_template = compile_template(curr_row)
+        row_config = get_row_config(curr_category, curr_row, df_vocab, indexes["vocab_indexes"], args)
+    except Exception as e:
+        return errors + [get_error_message(e)]
+
+    if row_config is None:
+        # the row is skipped (see `--no-proper-names`)
+        return errors
+
+    # the names are taken from the vocabulary of the subcategory unless the row has its own names
+    if curr_row.subcategory and not row_config["proper_names_only"] and not row_config["grouped_names_dict"] and row_config["df_vocab_cat"].empty:
+        errors.append(f"No vocabulary for the subcategory `{curr_row.subcategory}` of {curr_category}.")
+
+    # check that every variable has values to be substituted by (see `utils.resolve_variable`)
+    names_dict = row_config["grouped_names_dict"]
+    lex_div_dict = row_config["grouped_lex_div_dict"]
+    for column, segments in compiled_template.items():
+        for variable, label, specifier in segments[1::2]:
+            if label.startswith("WORD"):
+                if label not in lex_div_dict:
+                    errors.append(f"Column '{column}' contains '{variable}' but the lexical diversity column has no {label}.")
+                elif specifier not in lex_div_dict[label]:
+                    errors.append(f"Column '{column}' contains '{variable}' but the lexical diversity column has no {label}-{specifier}.")
+            elif label not in ("NAME1", "NAME2"):
+                errors.append(f"Column '{column}' contains the unrecognized variable '{variable}'.")
+            elif specifier is not None and not (lang == "ca" and curr_category == "SES" and curr_row.subcategory == "Occupation"):
+                if specifier not in names_dict.get(label, {}):
+                    errors.append(f"Column '{column}' contains '{variable}' but the names column has no {label}-{specifier}.")
+
+    try:
+        first_name_pair = next(iter_name_pairs(curr_category, curr_row, row_config, df_vocab, indexes["full_vocab_index"], df_proper_names, args))
+    except Exception as e:
+        return errors + [get_error_message(e)]
+
+    # fill the row once, to find the errors that only come up when filling the texts and assembling the instances
+    # (its permutations only swap NAME1 and NAME2, so they are not filled again)
+    try:
+        fill_instances(lang, curr_row, row_config, first_name_pair, row_config["lex_div_combinations"][0], indexes["names_index"], compiled_template, Profiler())
+    except Exception as e:
+        errors.append(get_error_message(e))
+
+    return errors
+
+def lint_category(curr_category: str, langs: list[str], df_vocabs: dict[str, pd.DataFrame], df_proper_names: dict[str, pd.DataFrame], args: argparse.Namespace) -> list[dict]:
+    """
+    Checks all the template rows of a category in each of the given languages (see `lint_template_row`), collecting all the errors instead of stopping at the first one (see `--lint`).
+    It only depends on its arguments, so that it can be run on its own worker process.
+
+    Returns:
+        list[dict]: The errors found, each with the spreadsheet, language, row (numbered like in the spreadsheet), template_id, version and message.
+    """
+
+    sheet_fn = os.path.join(args.templates_dir, f"{curr_category}.xlsx")
+
+    try:
+        df_categories = read_spreadsheet_cached(sheet_fn, langs, read_category_spreadsheet, use_cache=not args.no_cache, cache_dir=args.cache_dir)
+    except Exception as e:
+        return [{"sheet": sheet_fn, "language": ", ".join(langs), "row": None, "template_id": None, "version": None, "error": get_error_message(e)}]
+
+    errors = []
+    for lang in langs:
+        indexes = {
+            "full_vocab_index": build_vocab_index(df_vocabs[lang]),
+            "names_index": build_proper_names_index(df_proper_names[lang]),
+            "vocab_indexes": {},
+        }
+
+        for row_idx, row in zip(df_categories[lang].index, df_categories[lang].to_dict("records")):
+            # rows are numbered like in the spreadsheet (the first row is the header)
+            location = {"sheet": sheet_fn, "language": lang, "row": row_idx + 2, "template_id": row.get("esbbq_template_id"), "version": row.get("version")}
+
+            try:
+                curr_row = TemplateRow.from_dict(row)
+            except Exception as e:
+                errors.append({**location, "error": get_error_message(e)})
+                continue
+
+            for error in lint_template_row(curr_category, row_idx, curr_row, lang, df_vocabs[lang], df_proper_names[lang], indexes, args):
+                errors.append({**location, "error": error})
+
+    return errors
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """
+    Creates the parser of the CLI arguments, which are also the options of `Generator`.
+    """
+    parser = argparse.ArgumentParser(prog="Generate EsBBQ Instances", description="This script will read the Excel files in the input folder and generate EsBBQ instances for all the categories. By default, generates instances from all the templates in all the categories.")
+    parser.add_argument("--language", nargs="+", choices=languages, help="Space-separated language(s) to process templates and generate instances. With several languages, the templates are read once and the instances of all of them are generated in a single traversal, aligned by instance_id (the rows whose options don't match across languages are skipped, and an instance is dropped in all the languages if it's a duplicate in any of them), and saved to `data_<language>/<category>.<suffix>.aligned.<format>` instead of the datasets of each language.", required=True)
+    parser.add_argument("--categories", nargs="+", help="Space-separated list of categories to process templates and generate instances (the names of the spreadsheets in the templates folder). If not passed, will run for all available categories.")
+    parser.add_argument("--templates-dir", default=default_templates_dir, help="Folder with the spreadsheets of templates of each category and the vocabulary.")
+    parser.add_argument("--output-dir", default=default_output_dir, help="Folder where the instances (`data_<language>/`) and the statistics (`stats/`) are saved.")
+    parser.add_argument("--cache-dir", default=default_cache_dir, help="Folder where the pre-processed spreadsheets and the hashes of the template rows of the incremental mode are cached.")
+    parser.add_argument("--minimal", action="store_true", help="Minimize the sources of variation in instances by only taking one option from each source of variation.")
+    parser.add_argument("--max-lex-div-combinations", type=int, default=1000, metavar="N", help="Maximum number of combinations of lexical diversity (WORD1, WORD2, ...) used to fill each template row, so that a single template can't blow up the memory or runtime of its category. Rows with more combinations only use the first N, with a warning. Use 0 to remove the limit.")
+    parser.add_argument("--output-formats", nargs="+", choices=output_format_choices, default=default_output_formats, help="Space-separated format(s) in which to save the instances.")
+    parser.add_argument("--dry-run", action="store_true", help="Generate the templates and print the logs and stats but don't actually save them to file.")
+    parser.add_argument("--no-proper-names", action="store_true", help="Ignore the templates that require proper names in all categories contemplated.")
+    parser.add_argument("--save-fertility", action="store_true", help="Save an extra CSV with the fertility (instance count) of each template.")
+    parser.add_argument("--no-cache", action="store_true", help=f"Always parse the Excel spreadsheets instead of using the pre-processed versions cached in `<cache folder>/{template_cache_dir}`.")
+    parser.add_argument("--incremental", action="store_true", help="Only regenerate the templates that changed since the previous run (or whose vocabulary changed) and copy the instances of the rest from the existing JSONL output.")
+    parser.add_argument("--count-only", action="store_true", help="Compute the number of instances of each template combinatorially, without generating or saving them (use with --save-fertility to save the counts). Only available for one language at a time.")
+    sample_group = parser.add_mutually_exclusive_group()
+    sample_group.add_argument("--sample", type=int, metavar="N", help="Only generate a random sample of N instances of each template (or all of them, if it has fewer), drawn without generating the rest. Instances are saved to `data_<language>/<category>.sample.<format>`.")
+    sample_group.add_argument("--sample-budget", type=int, metavar="N", help="Only generate a random sample of N instances in total, split evenly among the categories. Instances are saved to `data_<language>/<category>.sample.<format>`.")
+    parser.add_argument("--sample-strategy", choices=sample_strategies, default="uniform", help="How to draw the instances when sampling: uniformly (from each template, or from each category with --sample-budget), or stratified to draw the same number of instances from each stereotyped group and permutation of NAME1 and NAME2 of each template.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator used when sampling, so that the same instances are drawn in every run.")
+    parser.add_argument("--shard", type=int, metavar="I", help="Only generate the instances of shard I (from 0 to --num-shards - 1), to split the generation among independent machines. The template rows and values of NAME1 are split deterministically among the shards, and the instances of each shard are saved to `data_<language>/shards/`. Only available for one language at a time.")
+    parser.add_argument("--num-shards", type=int, default=1, metavar="N", help="Number of shards into which the generation is split (see --shard and --merge-shards).")
+    parser.add_argument("--merge-shards", action="store_true", help="Merge the instances generated by all the --num-shards shards (with the same options) and save them to the output files, with the same instance_ids as in a run on a single node.")
+    parser.add_argument("--profile", action="store_true", help="Measure the wall time and peak memory of reading the vocabulary files and of each stage of the generation of each category, and save the time spent on each template to `stats/<language>/template_fertility/<category>.timing.csv` (in the output folder). Tracing memory slows down the generation.")
+    parser.add_argument("--lint", action="store_true", help="Check all the template rows of the categories in the given languages for errors that would stop the generation, and report all of them (with their spreadsheet, row and template_id) instead of generating the instances. Exits with an error if any is found.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes to use. Each category is generated (or linted) on its own process and writes its own output files. By default, categories are generated one at a time and linted on all the CPUs.")
+    return parser
+
+def validate_args(args: argparse.Namespace) -> None:
+    """
+    Checks that the combination of options is valid, and fills in the languages (without repetitions) and the categories (all the available ones, if not given).
+
+    Raises:
+        ValueError: If any of the options is not valid or they can't be used together.
+    """
+
+    # get languages (without repetitions)
+    unknown_langs = [lang for lang in args.language if lang not in languages]
+    if unknown_langs:
+        raise ValueError(f"Unknown language(s): {', '.join(unknown_langs)}. Available languages: {', '.join(languages)}.")
+    args.language = list(dict.fromkeys(args.language))
+    langs = args.language
+
+    available_categories = get_categories(args.templates_dir)
+    if args.categories is None:
+        args.categories = available_categories
+    unknown_categories = [curr_category for curr_category in args.categories if curr_category not in available_categories]
+    if unknown_categories:
+        raise ValueError(f"Unknown categories: {', '.join(unknown_categories)}. Available categories: {', '.join(available_categories)}.")
+
+    if args.incremental and len(langs) > 1:
+        raise ValueError("--incremental can only be used with one language at a time.")
+
+    if args.count_only and len(langs) > 1:
+        raise ValueError("--count-only can only be used with one language at a time.")
+
+    if args.max_lex_div_combinations < 0:
+        raise ValueError("--max-lex-div-combinations must be a positive number of combinations, or 0 to remove the limit.")
+
+    if args.shard is not None or args.merge_shards:
+        if args.shard is not None and args.merge_shards:
+            raise ValueError("--shard and --merge-shards can't be used together: generate each shard first and then merge them.")
+        if args.shard is not None and not 0 <= args.shard < args.num_shards:
+            raise ValueError("--shard must be between 0 and --num-shards - 1.")
+        if len(langs) > 1 or args.incremental or args.count_only or is_sampling(args):
+            raise ValueError("--shard and --merge-shards can only be used with one language at a time, and not with --incremental, --count-only or sampling.")
+
+    if is_sampling(args):
+        if args.sample is not None and args.sample_budget is not None:
+            raise ValueError("--sample and --sample-budget can't be used together.")
+        if args.minimal or args.incremental or args.count_only:
+            raise ValueError("--sample and --sample-budget can't be used with --minimal, --incremental or --count-only.")
+        if (args.sample if args.sample is not None else args.sample_budget) < 1:
+            raise ValueError("The sample size must be a positive number of instances.")
+
+class Generator:
+    """
+    Library entry point to generate the instances of EsBBQ and CaBBQ without going through the CLI.
+    The vocabularies are read once, when the generator is created, and the templates of each category the first time they are used, so a long-lived process can keep them in memory and generate the instances of a category or of a single template on demand:
+
+        generator = Generator(["es", "ca"], minimal=True)
+        for instance in generator.iter_instances("Age", "es", template_id=1):
+            ...
+
+    The options are the same as those of the CLI (with underscores instead of dashes, e.g. `no_proper_names=True`), and change the instances generated in the same way.
+    The templates, the outputs and the caches are read from and saved to the given folders, which are relative to the working directory by default, like in the CLI.
+    """
+
+    def __init__(self, langs: list[str], templates_dir: str = default_templates_dir, output_dir: str = default_output_dir, cache_dir: str = default_cache_dir, **options):
+        # get the default value of all the options (the languages are checked along with the rest of the options in `validate_args`)
+        args = build_arg_parser().parse_args(["--language", languages[0], "--templates-dir", templates_dir, "--output-dir", output_dir, "--cache-dir", cache_dir])
+        args.language = list(langs)
+
+        for option, value in options.items():
+            if not hasattr(args, option) or option == "language":
+                raise TypeError(f"Unknown generation option: `{option}`")
+            setattr(args, option, value)
+
+        self._setup(args)
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "Generator":
         """
-        NAME1 LOOP
-        Iterate over the list of possible values for NAME1
+        Creates a generator with the options parsed from the CLI arguments (see `build_arg_parser`).
         """
+        generator = cls.__new__(cls)
+        generator._setup(args)
+        return generator
 
-        for name1 in name1_list:
+    def _setup(self, args: argparse.Namespace) -> None:
+        validate_args(args)
 
-            # set info field
-            if name1 in name1_info_dict:
-                name1_info = name1_info_dict[name1]
-            else:
-                name1_info = curr_row.get("NAME1_info")
+        self.args = args
+        self.langs = args.language
+
+        # measure the time and memory of reading the vocabulary files, if profiling (they are read once for all the categories, so they are reported apart from them)
+        profiler = Profiler(enabled=args.profile)
+        profiler.start()
+        start_time = time.perf_counter()
+
+        # read and pre-process vocabulary files (or their cached versions)
+        with profiler.stage("load"):
+            self.df_vocabs = read_spreadsheet_cached(os.path.join(args.templates_dir, "vocabulary.xlsx"), self.langs, read_vocabulary_spreadsheet, use_cache=not args.no_cache, cache_dir=args.cache_dir)
+            self.df_proper_names = read_spreadsheet_cached(os.path.join(args.templates_dir, "vocabulary_proper_names.xlsx"), self.langs, read_proper_names_spreadsheet, use_cache=not args.no_cache, cache_dir=args.cache_dir)
+
+        if args.profile:
+            profiler.stop()
+            print_profile("vocabulary", profiler, time.perf_counter() - start_time)
 
-            # set possible values for NAME2 here when they depend on NAME1
-            # (in which case they could not be determined before the NAME1 loop)
-            if curr_category == "SES":
-                if proper_names_only:
-                    # for SES with proper names, take NAME2 from the remaining white names different from NAME1
-                    df_other_names = df_proper_names[((df_proper_names.ethnicity == "blanco") | (df_proper_names.ethnicity == "blanc")) & (df_proper_names.proper_name != name1)]
+        # templates of each category (with all their permutations, if any) and language, read when first needed
+        self.template_rows = {}
 
-                    if stated_gender:
-                        # if the template states a specific gender to use, restrict to this gender or to genderless names
-                        df_other_names = df_other_names[df_other_names.gender.isin([stated_gender, ""])]
+    @property
+    def categories(self) -> list[str]:
+        return self.args.categories
 
-                    name2_list = df_other_names.proper_name.tolist()
+    def _read_template_rows(self, curr_category: str) -> dict[str, list[tuple[int, TemplateRow]]]:
+        df_categories = read_spreadsheet_cached(os.path.join(self.args.templates_dir, f"{curr_category}.xlsx"), self.langs, read_category_spreadsheet, use_cache=not self.args.no_cache, cache_dir=self.args.cache_dir)
+        return {lang: [(row_idx, TemplateRow.from_dict(row)) for row_idx, row in zip(df_category.index, df_category.to_dict("records"))] for lang, df_category in df_categories.items()}
 
-                elif curr_subcategory == "Occupation":
-                # for SES Occupations, NAME1 options can be either highSES or lowSES, so we ensure that NAME2 options are always in the opposite category
-                    name1_info = df_vocab_cat.loc[df_vocab.name == name1, "information"].iloc[0]
-                    name2_list = df_vocab_cat[df_vocab_cat.information != name1_info].name.unique().tolist()
+    def get_template_rows(self, curr_category: str, lang: str) -> list[tuple[int, TemplateRow]]:
+        """
+        Returns the template rows of a category in a language, with all their permutations (unless in minimal mode), each with the index of the original row in the spreadsheet.
+        """
+        if (curr_category, lang) not in self.template_rows:
+            for category_lang, template_rows in self._read_template_rows(curr_category).items():
+                if not self.args.minimal:
+                    template_rows, _ = get_all_permutations(template_rows)
+                self.template_rows[(curr_category, category_lang)] = template_rows
 
-            # for race/ethnicity, NAME2 options should be the same gender as NAME1 but with the non-stereotyped ethnicity
-            elif curr_category == "RaceEthnicity" and proper_names_only:
+        return self.template_rows[(curr_category, lang)]
 
-                # find the non-stereotyped ethnicity
-                non_stereotyped_groups = df_vocab[df_vocab.information == "not-stereotyped"].name.unique().tolist()
+    def get_aligned_template_rows(self, curr_category: str) -> list[tuple[int, dict[str, TemplateRow]]]:
+        """
+        Returns the template rows of a category in all the languages of the generator, with the permutations shared by all of them (unless in minimal mode, see `get_aligned_permutations`), each with the index of the original row in the spreadsheet.
+        """
+        if (curr_category, None) not in self.template_rows:
+            all_template_rows = self._read_template_rows(curr_category)
+            aligned_rows = [(row_idx, {lang: all_template_rows[lang][position][1] for lang in self.langs}) for position, (row_idx, _) in enumerate(all_template_rows[self.langs[0]])]
+            if not self.args.minimal:
+                aligned_rows, _ = get_aligned_permutations(aligned_rows)
+            self.template_rows[(curr_category, None)] = aligned_rows
 
-                # filter the proper names to those of the non-stereotyped ethnicity and same gender as NAME1
-                gender = name1_info.split(",")[0]
-                df_other_names = df_proper_names[(df_proper_names.ethnicity.isin(non_stereotyped_groups)) & (df_proper_names.gender == gender)]
+        return self.template_rows[(curr_category, None)]
 
-                # iterate over names to add them to the NAME2 list and save info
-                for _, name_row in df_other_names.iterrows():
-                    name = name_row.proper_name
-                    name2_list.append(name)
-                    name2_info_dict[name] = name_row.ethnicity      
+    def _iter_instances(self, curr_category: str, langs: list[str], template_id=None, version: str = None) -> Iterator[dict[str, dict]]:
+        # only keep the rows of the given template and version (if any)
+        is_selected = lambda row: (template_id is None or str(row.esbbq_template_id) == str(template_id)) and (version is None or row.version == version)
 
-            assert name2_list, "No names in the list of options for NAME2!"
+        if len(langs) > 1 and not is_sampling(self.args):
+            # fill all the languages in a single traversal (see `generate_aligned_instances`)
+            aligned_rows = [(row_idx, rows) for row_idx, rows in self.get_aligned_template_rows(curr_category) if is_selected(rows[langs[0]])]
+            instances = generate_aligned_instances(curr_category, aligned_rows, self.df_vocabs, self.df_proper_names, self.args, Profiler())
 
-            if args.minimal:
-                name2_list = name2_list[:1]
-
-            """
-            NAME2 LOOP
-            Iterate over all the names in the NAME2 list
-            """
-            for name2 in name2_list:
-                if name2 in name2_info_dict:
-                    name2_info = name2_info_dict[name2]
+        else:
+            # instance streams of each language
+            instance_streams = {}
+            for lang in langs:
+                template_rows = [(row_idx, row) for row_idx, row in self.get_template_rows(curr_category, lang) if is_selected(row)]
+
+                if is_sampling(self.args):
+                    instance_streams[lang] = sample_category_instances(curr_category, template_rows, lang, self.df_vocabs[lang], self.df_proper_names[lang], self.args, Profiler())
                 else:
-                    name2_info = curr_row.get("NAME2_info")
-
-                if curr_category == "RaceEthnicity" and proper_names_only:
-                    name2_info = name2_info_dict[name2]
-
-                elif curr_category == "Gender" and proper_names_only:
-                    # if there is already some info on the row, append it to the existing information
-                    if curr_row.get("NAME1_info") and curr_row.get("NAME1_info") != name1_info:
-                        name1_info = f"{name1_info}, {curr_row.get('NAME1_info')}"
-                    if curr_row.get("NAME2_info") and curr_row.get("NAME2_info") != name2_info:
-                        name2_info = f"{name2_info}, {curr_row.get('NAME2_info')}"
-
-                    if "m, m" in name1_info or "m, m" in name2_info:
-                        breakpoint()
-
-                elif curr_category == "SES" and curr_subcategory == "Occupation":
-                    # get the info about each name from the vocab
-                    name1_vocab_row = df_vocab.loc[df_vocab.name == name1].iloc[0]
-                    name1_info = name1_vocab_row.get("information")
-                    name2_vocab_row = df_vocab.loc[df_vocab.name == name2].iloc[0]
-                    name2_info = name2_vocab_row.get("information")
-
-                # if there is still no info, use the name itself
-                if not name1_info:
-                    name1_info = name1
-
-                if not name2_info:
-                    name2_info = name2
-
-                # iterate over combinations to generate every possible version of the texts
-                for curr_lex_div in lex_div_combinations:
-                    new_row, values_used = fill_template(language=lang,
-                                                        template_row=curr_row, 
-                                                        name1=name1, 
-                                                        # gs_name1=None, 
-                                                        name2=name2, 
-                                                        # gs_name2=None, 
-                                                        names_dict=grouped_names_dict, 
-                                                        lex_div_dict=grouped_lex_div_dict, 
-                                                        lex_div_assignment=curr_lex_div, 
-                                                        stated_gender=stated_gender,
-                                                        df_vocab=df_vocab_cat,
-                                                        proper_names_only=proper_names_only,
-                                                        df_names=df_names,
-                                                        df_other_names=df_other_names
-                                                        )
-
-                    if new_row is None:
-                        continue
-
-                    # with the texts filled, create all possible instances that use them
-                    new_instances: list[dict] = generate_instances(language=lang, row=new_row, bias_targets=bias_targets, values_used=values_used, name1_info=name1_info, name2_info=name2_info, proper_names_only=proper_names_only)
-                    generated_instances.extend(new_instances)
-
-    assert len(generated_instances), f"No instances generated for {curr_category}!"
-
-    # Generating all possible permutations of NAME1 and NAME2 creates duplicates. Deduplicate df before saving it
-    if not args.minimal:
-        # Set to track the unique combinations of relevant columns
-        seen = set()
-        deduplicated = []
-        for instance in generated_instances:
-            identifier = (instance["template_id"], instance["context"], instance["question"])
-            if identifier not in seen:
-                deduplicated.append(instance)
-                seen.add(identifier)
-        generated_instances = deduplicated
-    
-    print(f"[{curr_category}] Generated {len(generated_instances)} sentences total.")
-
-    # now that all the instances are generated, add sequential IDs to each instance dict
-    generated_instances = [{"instance_id": instance_id, **instance_dict} for instance_id, instance_dict in enumerate(generated_instances)]
-
-    # calculate the fertility of each template (indexed by template_id and version) by counting the unique instance IDs
-    df_category_fertility = pd.DataFrame(generated_instances).groupby(["template_id", "version"])["instance_id"].count().reset_index().rename(columns={"instance_id": "instances"})
-
-    if args.save_fertility:
-        # save the fertility dict to a CSV under stats/template_fertility
-        if not os.path.exists(f"stats/{lang}/template_fertility"):
-            os.makedirs(f"stats/{lang}/template_fertility")
-        fertility_fn = f"stats/{lang}/template_fertility/{curr_category}.fertility.csv"
-        df_category_fertility.to_csv(fertility_fn, index=False)
-        print(f"[{curr_category}] Fertility saved to `{fertility_fn}`.")
+                    instance_streams[lang] = generate_category_instances(curr_category, template_rows, lang, self.df_vocabs[lang], self.df_proper_names[lang], self.args, {}, Profiler())
 
-    # save stats
-    df_stats.at[curr_category, "total_instances"] = len(generated_instances)
-    df_stats.at[curr_category, "avg_fertility"] = round(df_category_fertility.instances.mean())
+            if len(langs) > 1:
+                row_indexes = list(dict.fromkeys(row_idx for row_idx, _ in template_rows))
+                instances = align_instances(curr_category, instance_streams, row_indexes)
+            else:
+                instances = ((row_idx, {langs[0]: instance}) for row_idx, instance in instance_streams[langs[0]])
 
-    if args.minimal:
-        output_fn_prefix = f"data_{lang}/{curr_category}.minimal."
-    else:
-        output_fn_prefix = f"data_{lang}/{curr_category}.full."
+        if not self.args.minimal:
+            instances = deduplicate_instances(instances, Profiler())
+
+        for instance_id, (_, aligned_instances) in enumerate(instances):
+            yield {lang: {"instance_id": instance_id, **instance} for lang, instance in aligned_instances.items()}
+
+    def iter_instances(self, curr_category: str, lang: str = None, template_id=None, version: str = None) -> Iterator[dict]:
+        """
+        Generates the instances of a category in one language, one at a time and without saving them.
+        The instances of the whole category are the same, with the same `instance_id`s, as the ones saved by the CLI for that language alone. If a template is given, only its instances are generated, numbered from 0.
+
+        Args:
+            curr_category (str): The category of the templates.
+            lang (str): The language of the instances. By default, the first language of the generator.
+            template_id: Only generate the instances of the template with this ID.
+            version (str): Only generate the instances of this version of the template(s).
+
+        Yields:
+            dict: Each of the instances.
+        """
+        lang = lang or self.langs[0]
+        for aligned_instances in self._iter_instances(curr_category, [lang], template_id, version):
+            yield aligned_instances[lang]
+
+    def iter_aligned_instances(self, curr_category: str, template_id=None, version: str = None) -> Iterator[dict[str, dict]]:
+        """
+        Generates the instances of a category in all the languages of the generator at the same time, aligned by `instance_id` (see `generate_aligned_instances`), one at a time and without saving them.
+
+        Args:
+            curr_category (str): The category of the templates.
+            template_id: Only generate the instances of the template with this ID.
+            version (str): Only generate the instances of this version of the template(s).
+
+        Yields:
+            dict[str, dict]: The instance of each language.
+        """
+        yield from self._iter_instances(curr_category, self.langs, template_id, version)
+
+    def count_instances(self, curr_category: str, lang: str = None) -> Counter:
+        """
+        Computes the number of instances of each template of a category in one language without generating them (see `count_category_instances`).
+        """
+        lang = lang or self.langs[0]
+        return count_category_instances(curr_category, self.get_template_rows(curr_category, lang), lang, self.df_vocabs[lang], self.df_proper_names[lang], self.args)
+
+    def generate_category(self, curr_category: str) -> dict:
+        """
+        Generates all the instances of a category in all the languages and saves them to the output files, like the CLI (see `generate_category`).
+        """
+        return generate_category(curr_category, self.langs, self.df_vocabs, self.df_proper_names, self.args)
+
+    def generate_categories(self, categories: list[str] = None) -> dict[str, dict]:
+        """
+        Generates and saves the instances of several categories (by default, the ones the generator was created with), on `workers` worker processes if there are more than one.
+
+        Returns:
+            dict[str, dict]: The statistics of each category.
+        """
+        categories = categories or self.categories
+        workers = self.args.workers or 1
+
+        if workers > 1:
+            # run each category on its own worker process
+            with ProcessPoolExecutor(max_workers=min(workers, len(categories))) as executor:
+                futures = {curr_category: executor.submit(generate_category, curr_category, self.langs, self.df_vocabs, self.df_proper_names, self.args) for curr_category in categories}
+                return {curr_category: future.result() for curr_category, future in futures.items()}
+
+        # iterate over categories to read all the templates and fill them in
+        return {curr_category: self.generate_category(curr_category) for curr_category in categories}
+
+    def lint_categories(self, categories: list[str] = None) -> list[dict]:
+        """
+        Checks all the template rows of several categories (by default, the ones the generator was created with) in all the languages, on `workers` worker processes (by default, one per CPU), and collects all the errors found (see `lint_category`).
+
+        Returns:
+            list[dict]: The errors found, each with the spreadsheet, language, row, template_id, version and message.
+        """
+        categories = categories or self.categories
+        workers = self.args.workers or os.cpu_count() or 1
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(categories))) as executor:
+                futures = [executor.submit(lint_category, curr_category, self.langs, self.df_vocabs, self.df_proper_names, self.args) for curr_category in categories]
+                return [error for future in futures for error in future.result()]
+
+        return [error for curr_category in categories for error in lint_category(curr_category, self.langs, self.df_vocabs, self.df_proper_names, self.args)]
 
-    # save as JSONL
-    if "jsonl" in args.output_formats and not args.dry_run:
-        output_fn = output_fn_prefix + "jsonl"
+if __name__ == "__main__":
+    # create parser for the CLI arguments
+    parser = build_arg_parser()
+    args = parser.parse_args()
 
-        # convert the examples to JSON strings
-        json_lines: list[str] = [json.dumps(example_dict, default=str, ensure_ascii=False) for example_dict in generated_instances]
+    try:
+        generator = Generator.from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
 
-        # print to file
-        with open(output_fn, "w+") as output_file:
-            print(*json_lines, sep="\n", file=output_file)
-            print(f"[{curr_category}] Instances saved to `{output_fn}`.")
+    if args.lint:
+        from tabulate import tabulate
 
-    # save as CSV
-    if "csv" in args.output_formats and not args.dry_run:
-        output_fn = output_fn_prefix + "csv"
+        errors = generator.lint_categories()
+        if errors:
+            print(tabulate(errors, headers="keys", tablefmt="psql"))
+        print(f"Found {len(errors)} errors in {len({(error['sheet'], error['row']) for error in errors})} template rows of {len(generator.categories)} categories ({', '.join(generator.langs)}).")
+        sys.exit(1 if errors else 0)
 
-        # flatten all the instances because CSV can't handle nested dicts
-        flattened_examples = [flatten_nested_dicts(example_dict) for example_dict in generated_instances]
+    all_stats = generator.generate_categories()
 
-        # convert instance dicts to DataFrame and save to CSV
-        df_instances = pd.DataFrame(flattened_examples)
-        df_instances.to_csv(output_fn, index=False)
-        print(f"[{curr_category}] Instances saved to `{output_fn}`.")
+    import pandas as pd
+    from tabulate import tabulate
 
-    print()
+    # merge the statistics of all the categories into one DF (keeping the order of the categories passed)
+    df_stats = pd.DataFrame.from_dict(all_stats, orient="index")
 
-print("Summary:")
-print("Be careful! Avg fertility is computed among all instances, not per template.")
-print(tabulate(df_stats.reset_index(), headers=["category", *df_stats.columns], tablefmt="psql"))
+    print("Summary:")
+    print("Be careful! Avg fertility is computed among all instances, not per template.")
+    print(tabulate(df_stats.reset_index(), headers=["category", *df_stats.columns], tablefmt="psql"))
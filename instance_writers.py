@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+from typing import TYPE_CHECKING
+
+from utils import flatten_nested_dicts
+
+# pandas is only needed when the instances are read from Parquet
+if TYPE_CHECKING:
+    import pandas as pd
+
+class InstanceWriter:
+    """
+    Base class for the writers that save the generated instances to a file one at a time, as they are produced.
+    The instances are written to a temporary file that only replaces the output file when the writer is closed without errors, so a failed run never leaves a half-written output behind.
+    Writers are meant to be used as context managers:
+
+        with JsonlInstanceWriter("data_es/Age.full.jsonl") as writer:
+            for instance in instances:
+                writer.write(instance)
+    """
+
+    def __init__(self, output_fn: str):
+        self.output_fn = output_fn
+        self.tmp_fn = f"{output_fn}.{os.getpid()}.tmp"
+        self.num_instances = 0
+
+    def write(self, instance: dict) -> None:
+        self._write(instance)
+        self.num_instances += 1
+
+    def _write(self, instance: dict) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close()
+
+        if exc_type is None:
+            os.replace(self.tmp_fn, self.output_fn)
+        elif os.path.exists(self.tmp_fn):
+            os.remove(self.tmp_fn)
+
+def get_jsonl_index_fn(jsonl_fn: str) -> str:
+    """
+    Returns the path of the sidecar index of a JSONL file of instances.
+    """
+    return f"{jsonl_fn}.index.json"
+
+def get_template_key(template_id, version: str, flipped: str) -> str:
+    """
+    Returns the key used in the sidecar index to group the instances of each template variant.
+    """
+    return f"{template_id}|{version}|{flipped}"
+
+def save_jsonl_index(jsonl_fn: str, index: dict) -> None:
+    """
+    Saves the sidecar index of a JSONL file of instances (see `get_jsonl_index_fn`) atomically, so that a half-written index is never read.
+    """
+    index_fn = get_jsonl_index_fn(jsonl_fn)
+    tmp_index_fn = f"{index_fn}.{os.getpid()}.tmp"
+    with open(tmp_index_fn, "w") as index_file:
+        json.dump(index, index_file, default=str, ensure_ascii=False)
+    os.replace(tmp_index_fn, index_fn)
+
+def build_jsonl_index(jsonl_fn: str) -> dict:
+    """
+    Rebuilds the sidecar index of an existing JSONL file of instances (e.g. of the committed datasets, whose indexes are not committed), reading it one line at a time.
+    The index is the same one that `JsonlInstanceWriter` saves when the instances are generated.
+    """
+    jsonl_hash = hashlib.sha256()
+    index = {"jsonl_size": 0, "jsonl_sha256": None, "instance_ids": [], "offsets": [], "templates": {}}
+
+    with open(jsonl_fn, "rb") as f:
+        for line in f:
+            instance = json.loads(line)
+            jsonl_hash.update(line)
+            index["instance_ids"].append(instance["instance_id"])
+            index["offsets"].append(index["jsonl_size"])
+            index["templates"].setdefault(get_template_key(instance["template_id"], instance["version"], instance["flipped"]), []).append(instance["instance_id"])
+            index["jsonl_size"] += len(line)
+
+    index["jsonl_sha256"] = jsonl_hash.hexdigest()
+    return index
+
+class JsonlInstanceWriter(InstanceWriter):
+    """
+    Writes one JSON line per instance. It also keeps the SHA-256 hash of the contents written, available in `sha256` once the writer is closed.
+    Next to the output file it saves a sidecar index (see `get_jsonl_index_fn`) with the byte offset of each instance and the instances of each (template_id, version, flipped), so that single instances can be fetched with `IndexedJsonlReader` without parsing the whole file.
+    """
+
+    def __init__(self, output_fn: str):
+        super().__init__(output_fn)
+        self.output_file = open(self.tmp_fn, "wb")
+        self.hash = hashlib.sha256()
+        self.sha256 = None
+        self.offset = 0
+        self.instance_ids = []
+        self.offsets = []
+        self.templates = {}
+
+    def _write(self, instance: dict) -> None:
+        line = (json.dumps(instance, default=str, ensure_ascii=False) + "\n").encode("utf-8")
+        self.output_file.write(line)
+        self.hash.update(line)
+
+        # save the position of the instance for the index
+        self.instance_ids.append(instance["instance_id"])
+        self.offsets.append(self.offset)
+        self.templates.setdefault(get_template_key(instance["template_id"], instance["version"], instance["flipped"]), []).append(instance["instance_id"])
+        self.offset += len(line)
+
+    def _close(self) -> None:
+        self.output_file.close()
+        self.sha256 = self.hash.hexdigest()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+
+        # the index is only saved (also atomically) once the output file is in place
+        if exc_type is None:
+            save_jsonl_index(self.output_fn, {
+                "jsonl_size": self.offset,
+                "jsonl_sha256": self.sha256,
+                "instance_ids": self.instance_ids,
+                "offsets": self.offsets,
+                "templates": self.templates,
+            })
+
+class IndexedJsonlReader:
+    """
+    Fetches individual instances from a JSONL file of instances by `instance_id` or by template, using the sidecar index saved by `JsonlInstanceWriter`.
+    The file is memory-mapped, so each instance is read and parsed only when it is requested. Readers are meant to be used as context managers:
+
+        with IndexedJsonlReader("data_es/Age.full.jsonl") as reader:
+            instance = reader[42]
+            instances = reader.get_template(1, "a", "original")
+    """
+
+    def __init__(self, jsonl_fn: str):
+        with open(get_jsonl_index_fn(jsonl_fn)) as index_file:
+            index = json.load(index_file)
+
+        self.jsonl_fn = jsonl_fn
+        self.offsets = dict(zip(index["instance_ids"], index["offsets"]))
+        self.templates = index["templates"]
+
+        # the index is only valid for the file it was created with (the size is a cheap check to detect files regenerated without index)
+        if os.path.getsize(jsonl_fn) != index["jsonl_size"]:
+            raise Exception(f"The index of `{jsonl_fn}` is outdated, rebuild it with `python instance_writers.py {jsonl_fn}`.")
+
+        self.input_file = open(jsonl_fn, "rb")
+        self.mm = mmap.mmap(self.input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, instance_id: int) -> bool:
+        return instance_id in self.offsets
+
+    def __getitem__(self, instance_id: int) -> dict:
+        offset = self.offsets[instance_id]
+        end = self.mm.find(b"\n", offset)
+        return json.loads(self.mm[offset:end if end != -1 else len(self.mm)])
+
+    def get_many(self, instance_ids: list[int]) -> list[dict]:
+        """
+        Returns the instances with the given IDs, in the same order (reading the file in order of position).
+        """
+        instances = {instance_id: self[instance_id] for instance_id in sorted(set(instance_ids), key=self.offsets.__getitem__)}
+        return [instances[instance_id] for instance_id in instance_ids]
+
+    def get_template(self, template_id, version: str, flipped: str) -> list[dict]:
+        """
+        Returns all the instances generated from a template variant, i.e. from the given (template_id, version, flipped).
+        """
+        return self.get_many(self.templates.get(get_template_key(template_id, version, flipped), []))
+
+    def close(self) -> None:
+        self.mm.close()
+        self.input_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# columns of the instances saved as CSV, following the layout of the instances built in `utils.generate_instances` with the answer information flattened (see `utils.flatten_nested_dicts`)
+csv_columns = [
+    "instance_id",
+    "template_id",
+    "version",
+    "template_label",
+    "flipped",
+    "question_polarity",
+    "context_condition",
+    "category",
+    "subcategory",
+    "relevant_social_value",
+    "stereotyped_groups",
+    "answer_info.ans0",
+    "answer_info.ans1",
+    "answer_info.ans2",
+    "stated_gender_info",
+    "proper_nouns_only",
+    "context",
+    "question",
+    "ans0",
+    "ans1",
+    "ans2",
+    "question_type",
+    "label",
+    "source",
+]
+
+class CsvInstanceWriter(InstanceWriter):
+    """
+    Writes the instances as CSV rows with the columns in `csv_columns`, flattening the nested dicts because CSV can't handle them.
+    Each row is written as soon as the instance is produced, in the same format that pandas uses (lists are written as their Python representation), so memory does not grow with the number of instances.
+    """
+
+    def __init__(self, output_fn: str):
+        super().__init__(output_fn)
+        self.output_file = open(self.tmp_fn, "w", newline="", encoding="utf-8")
+
+        # fields that are not in the columns raise an error instead of being dropped silently
+        self.writer = csv.DictWriter(self.output_file, fieldnames=csv_columns, lineterminator="\n")
+        self.writer.writeheader()
+
+    def _write(self, instance: dict) -> None:
+        self.writer.writerow(flatten_nested_dicts(instance))
+
+    def _close(self) -> None:
+        self.output_file.close()
+
+def get_parquet_schema():
+    """
+    Returns the Arrow schema of the instances saved as Parquet, following the layout of the instances built in `utils.generate_instances`.
+    Lists and answer information are stored with real list and struct types, and the fields that repeat heavily across instances are dictionary-encoded (they are read back as categoricals in pandas).
+
+    Returns:
+        pyarrow.Schema: The schema of the instances.
+    """
+    import pyarrow as pa
+
+    dictionary_string = pa.dictionary(pa.int32(), pa.string())
+    answer_info = pa.list_(pa.string())
+
+    return pa.schema([
+        ("instance_id", pa.int64()),
+        ("template_id", pa.int64()),
+        ("version", dictionary_string),
+        ("template_label", dictionary_string),
+        ("flipped", dictionary_string),
+        ("question_polarity", dictionary_string),
+        ("context_condition", dictionary_string),
+        ("category", dictionary_string),
+        ("subcategory", dictionary_string),
+        ("relevant_social_value", dictionary_string),
+        ("stereotyped_groups", pa.list_(dictionary_string)),
+        ("answer_info", pa.struct([("ans0", answer_info), ("ans1", answer_info), ("ans2", answer_info)])),
+        ("stated_gender_info", dictionary_string),
+        ("proper_nouns_only", pa.bool_()),
+        ("context", pa.string()),
+        ("question", pa.string()),
+        ("ans0", pa.string()),
+        ("ans1", pa.string()),
+        ("ans2", pa.string()),
+        ("question_type", dictionary_string),
+        ("label", pa.int64()),
+        ("source", pa.list_(dictionary_string)),
+    ])
+
+class ParquetInstanceWriter(InstanceWriter):
+    """
+    Writes the instances to a Parquet file, keeping lists and nested dicts as Arrow list and struct types.
+    The instances are buffered and written as a new row group every `chunk_size` instances, so that memory does not grow with the number of instances.
+    pyarrow is only imported when this writer is used, so it is not required for the other output formats.
+    """
+
+    def __init__(self, output_fn: str, chunk_size: int = 10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        super().__init__(output_fn)
+        self.pa = pa
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.schema = get_parquet_schema()
+        self.output_file = pq.ParquetWriter(self.tmp_fn, self.schema, compression="zstd")
+
+    def _write(self, instance: dict) -> None:
+        self.buffer.append(instance)
+
+        if len(self.buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.buffer:
+            self.output_file.write_table(self.pa.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+    def _close(self) -> None:
+        self._flush()
+        self.output_file.close()
+
+def read_parquet_instances(input_fn: str, columns: list[str] = None, filters: list = None) -> pd.DataFrame:
+    """
+    Reads instances saved in Parquet format, only loading the requested columns and the instances that pass the filters.
+    Filters use the pyarrow format, e.g. `[("context_condition", "==", "ambig")]`, and are pushed down to the reader so that the rest of the file is skipped.
+
+    Args:
+        input_fn (str): Path to the Parquet file.
+        columns (list[str]): Columns to read. All the columns are read if not specified.
+        filters (list): Predicates that the instances must satisfy, in the format accepted by `pyarrow.parquet.read_table`.
+
+    Returns:
+        pd.DataFrame: The instances read, with the dictionary-encoded fields as categoricals.
+    """
+    import pyarrow.parquet as pq
+
+    return pq.read_table(input_fn, columns=columns, filters=filters).to_pandas()
+
+# writer class for each of the output formats
+instance_writers = {
+    "jsonl": JsonlInstanceWriter,
+    "csv": CsvInstanceWriter,
+    "parquet": ParquetInstanceWriter,
+}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rebuilds the sidecar index (`<file>.jsonl.index.json`) of existing JSONL files of instances, which `IndexedJsonlReader` needs to fetch instances without reading the whole file. The indexes are saved whenever the instances are generated, but they are not committed along with the datasets.")
+    parser.add_argument("jsonl_fns", nargs="+", metavar="JSONL", help="Space-separated JSONL files of instances whose indexes are rebuilt.")
+
+    args = parser.parse_args()
+
+    for jsonl_fn in args.jsonl_fns:
+        save_jsonl_index(jsonl_fn, build_jsonl_index(jsonl_fn))
+        print(f"Index of `{jsonl_fn}` saved to `{get_jsonl_index_fn(jsonl_fn)}`.")
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Optional
+
+# pandas is only imported to build the tables of stats, once the profiled generation is over
+if TYPE_CHECKING:
+    import pandas as pd
+
+class Profiler:
+    """
+    Measures the wall time and the peak memory of each stage of the generation of a category (see `--profile`).
+    The time of the stages that run once per template row (filling and assembling the instances) is also accumulated per template, to find the templates that take the longest.
+    Memory tracing can be turned off with `trace_memory=False` to measure time alone, e.g. for benchmarks.
+    When disabled, `stage` returns a null context, so the instrumented code runs with almost no overhead:
+
+        profiler = Profiler(enabled=True)
+        with profiler.stage("fill", template=(template_id, version)):
+            fill_template(...)
+    """
+
+    def __init__(self, enabled: bool = False, trace_memory: bool = True):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.stage_times = Counter()
+        self.stage_peaks = Counter()
+        self.stage_calls = Counter()
+        self.template_times = Counter()
+
+    def start(self) -> None:
+        # memory is only traced while profiling, because tracing slows down every allocation
+        if self.enabled and self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self) -> None:
+        if self.enabled and self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def stage(self, name: str, template: tuple = None):
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, template)
+
+    @contextmanager
+    def _stage(self, name: str, template: tuple):
+        # the peak is reset at the start of each stage, so that it only covers the memory used while running it
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_times[name] += elapsed
+            if self.trace_memory:
+                self.stage_peaks[name] = max(self.stage_peaks[name], tracemalloc.get_traced_memory()[1])
+            self.stage_calls[name] += 1
+            if template is not None:
+                self.template_times[(*template, name)] += elapsed
+
+    def get_stage_stats(self, total_time: Optional[float] = None) -> pd.DataFrame:
+        """
+        Returns the number of calls, total wall time (in seconds) and peak memory (in MB) of each stage, in the order in which they first ran.
+
+        Args:
+            total_time (Optional[float]): The total wall time (in seconds) of the profiled run. If given, the time spent outside every stage is added as an `other` row, so that the times add up to the total.
+        """
+        import pandas as pd
+
+        df_stages = pd.DataFrame({
+            "calls": self.stage_calls,
+            "time_s": {stage: round(stage_time, 3) for stage, stage_time in self.stage_times.items()},
+            "peak_mb": {stage: round(peak / 2**20, 1) for stage, peak in self.stage_peaks.items()},
+        })
+
+        if total_time is not None:
+            df_stages.loc["other"] = [None, round(total_time - sum(self.stage_times.values()), 3), None]
+
+        return df_stages
+
+    def get_template_stats(self, template_counts: Counter) -> pd.DataFrame:
+        """
+        Returns the time spent on each stage for each template (indexed by template_id and version), along with its number of instances, sorted by total time.
+
+        Args:
+            template_counts (Counter): The number of instances of each (template_id, version).
+        """
+        import pandas as pd
+
+        df_templates = pd.Series(self.template_times, dtype=float).unstack(fill_value=0.0)
+        df_templates = df_templates[[stage for stage in self.stage_times if stage in df_templates.columns]]
+        df_templates.index.names = ["template_id", "version"]
+        df_templates.columns = [f"{stage}_time_s" for stage in df_templates.columns]
+        df_templates["total_time_s"] = df_templates.sum(axis=1)
+        df_templates["instances"] = [template_counts.get(template, 0) for template in df_templates.index]
+        return df_templates.sort_values("total_time_s", ascending=False).round(4).reset_index()
@@ -1,26 +1,144 @@
+from __future__ import annotations
+
 import itertools
+import math
 import re
-from collections import OrderedDict
-from typing import Optional
-
-import pandas as pd
-from nltk.tokenize import sent_tokenize
-
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, fields, replace
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+# pandas and NLTK are slow to import, so they are only imported for type checking here (the functions that need NLTK import it when first called)
+if TYPE_CHECKING:
+    import pandas as pd
+    from nltk.tokenize import PunktTokenizer
+
+# linguistic replacements of each language, in the order in which they are applied
+# the rules are split into stages, and all the rules of a stage are applied in a single regex pass (see `compile_ling_replacements`), so the rules of a stage must not rewrite a text into something that another rule of the same stage would match
+# a rule that needs the output of a previous rule goes to a later stage (e.g. in Catalan, "de a el" becomes "de al" and then "d'al")
 ling_replacements = {
     'es': [
-        (r"\bde el\b", "del"),
-        (r"\b([aA]) el\b", r"\1l"),
-        ("testigo de Jehová", "que es testigo de Jehová"), # improves naturality
+        [
+            (r"\bde el\b", "del"),
+            (r"\b([aA]) el\b", r"\1l"),
+            ("testigo de Jehová", "que es testigo de Jehová"), # improves naturality
+        ],
     ],
     'ca': [
-        (r"\bde el(s?)\b", r"del\1"),
-        (r"\b([aA]) el(s?)\b", r"\1l\2"),
-        (r"\bde ([aAeEèÈéÉiIoOòÒóÓuUhH])", r"d'\1"),
-        (r"\bd'io", r"de io"),
-        ("testimoni de Jehovà", "que és testimoni de Jehovà"), # improves naturality
+        [
+            (r"\bde el(s?)\b", r"del\1"),
+            (r"\b([aA]) el(s?)\b", r"\1l\2"),
+        ],
+        [
+            (r"\bde (?!io)([aAeEèÈéÉiIoOòÒóÓuUhH])", r"d'\1"), # "de io..." is excluded here instead of reverting "d'io..." with the next rule, so that no rule rewrites the output of another
+            (r"\bd'io", r"de io"),
+            ("testimoni de Jehovà", "que és testimoni de Jehovà"), # improves naturality
+        ],
     ]
 }
 
+def fuse_ling_replacements(replacements: list[tuple[str, str]]) -> Callable[[str], str]:
+    """
+    Fuses a list of (pattern, replacement) rules into a single regex so that a text can be rewritten in one pass instead of one `re.sub` per rule.
+    Each rule becomes one alternative of the fused regex (in the same order, so the earlier rule wins when several match at the same position), and the group references in its pattern and replacement are renumbered accordingly.
+    This is only equivalent to applying the rules one after the other if no rule rewrites a text into something that another rule would match, which is why `ling_replacements` is split into stages.
+
+    Args:
+        replacements (list[tuple[str, str]]): The rules to fuse, as (pattern, replacement) pairs for `re.sub`.
+
+    Returns:
+        Callable[[str], str]: A function that applies all the rules to a text.
+    """
+
+    alternatives = []
+    replacement_templates = {}
+    num_groups = 0
+
+    for pattern, replacement in replacements:
+        # the whole rule is wrapped in a group, so its own groups are shifted by the groups of the previous rules plus the wrapper
+        rule_group = num_groups + 1
+        shift_group = lambda match: f"\\g<{int(match.group(1) or match.group(2)) + rule_group}>"
+
+        alternatives.append("(" + re.sub(r"\\(\d+)", lambda match: f"(?:\\{int(match.group(1)) + rule_group})", pattern) + ")")
+        replacement_templates[rule_group] = re.sub(r"\\g<(\d+)>|\\(\d+)", shift_group, replacement)
+
+        num_groups = rule_group + re.compile(pattern).groups
+
+    fused_regex = re.compile("|".join(alternatives))
+
+    def apply_replacements(text: str) -> str:
+        # the wrapper group of the rule that matched is always the last one to close, i.e. `lastindex`
+        return fused_regex.sub(lambda match: match.expand(replacement_templates[match.lastindex]), text)
+
+    return apply_replacements
+
+def compile_ling_replacements(stages: list[list[tuple[str, str]]]) -> Callable[[str], str]:
+    """
+    Compiles the stages of rules of a language, like the ones in `ling_replacements`, into a function that rewrites a text with one regex pass per stage (see `fuse_ling_replacements`), applying the stages in order.
+    As long as the rules of each stage don't feed each other, the result is the same as applying all the rules one after the other with `re.sub` (this is checked by `benchmarks/check_ling_replacements.py`).
+
+    Args:
+        stages (list[list[tuple[str, str]]]): The stages of rules, as lists of (pattern, replacement) pairs for `re.sub`.
+
+    Returns:
+        Callable[[str], str]: A function that applies all the rules to a text.
+    """
+
+    stage_rewriters = [fuse_ling_replacements(replacements) for replacements in stages]
+
+    def apply_stages(text: str) -> str:
+        for rewrite_stage in stage_rewriters:
+            text = rewrite_stage(text)
+        return text
+
+    return apply_stages
+
+@lru_cache(maxsize=None)
+def get_ling_rewriter(language: str) -> Callable[[str], str]:
+    """
+    Compiles the linguistic replacements for the given language only once per process (see `compile_ling_replacements`).
+    """
+    return compile_ling_replacements(ling_replacements[language])
+
+@dataclass(frozen=True, slots=True)
+class TemplateRow:
+    """
+    Compact and immutable version of a row of the templates spreadsheet (once the columns of the language have been renamed), used throughout the generation instead of `pd.Series`.
+    Columns that are not in the spreadsheet of a category take the default values, and all the strings are stripped when the row is created, so we don't need to worry about extra spaces in the Excel spreadsheets.
+    """
+    esbbq_template_id: int | str = ""
+    version: str = ""
+    label: str = ""
+    esbbq_category: str = ""
+    subcategory: str = ""
+    ambiguous_context: str = ""
+    disambiguating_context: str = ""
+    names: str = ""
+    lexical_diversity: str = ""
+    proper_nouns_only: int | str = ""
+    question_negative_stereotype: str = ""
+    question_non_negative: str = ""
+    answer_negative: str = ""
+    answer_non_negative: str = ""
+    relevant_social_values: str = ""
+    stereotyped_groups: str = ""
+    non_stereotyped_groups: str = ""
+    NAME1_info: str = ""
+    NAME2_info: str = ""
+    stated_gender_info: str = ""
+    esbbq_source: str = ""
+    flipped: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, row: dict) -> "TemplateRow":
+        """
+        Creates a template row from a dict of column values (e.g. from `df.to_dict("records")`), ignoring the columns that are not used for the generation.
+        """
+        return cls(**{column: value.strip() if isinstance(value, str) else value for column, value in row.items() if column in template_row_fields})
+
+# names of the columns kept in `TemplateRow`
+template_row_fields = {field.name for field in fields(TemplateRow)}
+
 def flatten(input_list: list) -> list:
     return list(itertools.chain(*input_list))
 
@@ -30,7 +148,7 @@ def split_and_strip(s: str, sep: str) -> list[str]:
 def remove_brackets(s: str) -> str:
     return re.sub(r"(\{\{?)|(\}\}?)", "", s)
 
-def validate_template(template_row: pd.Series) -> None:
+def validate_template(template_row: TemplateRow) -> None:
     """
     This function performs some non-exhaustive checks to attempt and identify any errors in the templates that might trickle down and cause confusing errors in the code later.
     """
@@ -40,15 +158,152 @@ def validate_template(template_row: pd.Series) -> None:
 
     # if any context uses WORD variables, the row must include the lexical diversity column
     if "WORD" in template_row.ambiguous_context or "WORD" in template_row.disambiguating_context:
-        assert template_row.get("lexical_diversity"), "WORD variable used in context but lexical diversity is empty!"
+        assert template_row.lexical_diversity, "WORD variable used in context but lexical diversity is empty!"
 
     # except in Gender, stated gender is required in all the cases that don't use proper names
     if template_row.esbbq_category != 'Gender':
-        assert not (template_row.get("proper_nouns_only") == 1 and template_row.get("stated_gender_info") == ""), "No gender info stated!"
+        assert not (template_row.proper_nouns_only == 1 and template_row.stated_gender_info == ""), "No gender info stated!"
+
+def build_vocab_index(df_vocab: pd.DataFrame) -> dict[str, dict]:
+    """
+    Builds a dictionary that maps each name in the vocabulary to its row (as a dict with the masculine, feminine and definite forms and the information), so that names can be looked up in constant time.
+    If a name appears more than once, the first row is kept, like `df_vocab[df_vocab.name == name].iloc[0]` would do.
+    """
+    vocab_index = {}
+    for vocab_row in df_vocab.to_dict("records"):
+        vocab_index.setdefault(vocab_row["name"], vocab_row)
+
+    return vocab_index
+
+def build_proper_names_index(df_proper_names: pd.DataFrame) -> dict[str, dict]:
+    """
+    Builds a dictionary that maps each proper name to its row (as a dict with the definite form, gender and ethnicity), keeping the first row if a name appears more than once.
+    """
+    names_index = {}
+    for names_row in df_proper_names.to_dict("records"):
+        names_index.setdefault(names_row["proper_name"], names_row)
+
+    return names_index
+
+# columns of the template rows that might have variables to fill
+template_text_columns = ["ambiguous_context", "disambiguating_context", "lexical_diversity", "question_negative_stereotype", "question_non_negative", "answer_negative", "answer_non_negative"]
+
+def compile_template(template_row: TemplateRow) -> dict[str, list]:
+    """
+    Compiles the text columns of a template row so that they can be filled many times without having to search for the variables in the texts every time.
+    Each text is split into a list that alternates literal segments (in even positions) and slots (in odd positions). Each slot is a tuple of the variable, its label and its specifier, e.g. ("NAME1-def", "NAME1", "def") or ("WORD2", "WORD2", None).
+
+    Args:
+        template_row (TemplateRow): The template row that contains the texts to compile.
+
+    Returns:
+        dict[str, list]: The compiled text of each column.
+    """
+
+    compiled_template = {}
+
+    for curr_text_col in template_text_columns:
+        curr_text = getattr(template_row, curr_text_col)
+        assert isinstance(curr_text, str)
+
+        # splitting on the variables leaves the variable names in the odd positions
+        segments: list = re.split(r"\{\{([^\}]+)\}\}", curr_text.strip())
+
+        for slot_idx in range(1, len(segments), 2):
+            variable: str = segments[slot_idx]
+
+            if not (variable.startswith("NAME1") or variable.startswith("NAME2") or variable.startswith("WORD")):
+                raise Exception(f"Unrecognized variable in template with template_id={template_row.esbbq_template_id} column '{curr_text_col}': '{variable}'")
+
+            label, specifier = variable.split("-") if "-" in variable else (variable, None)
+            segments[slot_idx] = (variable, label, specifier)
+
+        compiled_template[curr_text_col] = segments
+
+    return compiled_template
+
+def resolve_variable(
+    language: str,
+    template_row: TemplateRow,
+    variable: str,
+    label: str,
+    specifier: Optional[str],
+    name1: str,
+    name2: str,
+    names_dict: dict,
+    lex_div_dict: dict[str, dict[str, list]],
+    lex_div_assignment: dict[str, int],
+    stated_gender: str,
+    vocab_index: dict[str, dict],
+    proper_names_only: bool,
+    names_index: dict[str, dict]
+) -> str:
+    """
+    Gets the value that substitutes a variable of a template for the given NAME1, NAME2 and lexical diversity combination (see `fill_template` for the rest of the arguments).
+
+    Args:
+        variable (str): The variable to resolve, e.g. "NAME1-def".
+        label (str): The variable without specifier, e.g. "NAME1".
+        specifier (Optional[str]): The specifier of the variable, e.g. "def", if any.
+
+    Returns:
+        str: The value of the variable.
+    """
+
+    if variable.startswith("NAME1") or variable.startswith("NAME2"):
+
+        selected_name: str = name1 if variable.startswith("NAME1") else name2
+
+        # variable will be replaced by the selected NAME1 or NAME2...(*)
+        subst: str = selected_name
+
+        # for CaBBQ, proper names need to be always preceded by the def article
+        if language == "ca" and proper_names_only:
+            subst = names_index[selected_name]["proper_name_def"]
+
+        # switch to feminine version if the stated_gender is F and a feminine version is available
+        if selected_name in vocab_index and stated_gender == "f":
+            vocab_row = vocab_index[selected_name]
+            subst = vocab_row["f"] if vocab_row["f"] else selected_name
+
+        # (*)...unless there is a specifier, in which case it needs to be replaced by its corresponding -def or -indef
+        if specifier is not None:
+
+            # exceptionally, for CaBBQ, vocabulary for Occupation subcat. in SES needs -def specifier to avoid ling. errors
+            if language == "ca" and template_row.esbbq_category == "SES" and template_row.subcategory == "Occupation":
+                vocab_row = vocab_index[selected_name]
+                # get feminine def version
+                if stated_gender == "f":
+                    subst = vocab_row["f_def"]
+                # get masc def version
+                else:
+                    subst = vocab_row["name_def"]
+
+            # for all other cases:
+            else: 
+                assert names_dict, f"Variables with specifiers like '{variable}' can only be used with Names but the names column is empty."
+                selected_name_idx: int = names_dict[label][None].index(selected_name)
+                desired_group: list = names_dict[label][specifier]
+                subst = desired_group[selected_name_idx]
+
+    # otherwise, it is a WORD variable (the rest are rejected by compile_template)
+    else:
+        assert lex_div_dict and lex_div_assignment is not None, f"Text contains '{variable}' but no lexical diversity was found."
+
+        curr_word_idx: int = lex_div_assignment[label]
+        desired_group: list = lex_div_dict[label][specifier]
+        subst: str = desired_group[curr_word_idx]
+
+    # TODO[intersectionals -: this is untested and hasn't been used yet
+    # elif variable in ["GEN1", "GEN2", "OCC1", "OCC2"]:
+    #     assert (variable.endswith("1") and gs_name1 is not None) or (variable.endswith("2") and gs_name2 is not None)
+    #     subst = gs_name1 if variable.endswith("1") else gs_name2
+
+    return subst
 
 def fill_template(
     language: str,
-    template_row: pd.Series,
+    template_row: TemplateRow,
     name1: str,
     # gs_name1, # TODO [intersectionals]
     name2: str,
@@ -57,123 +312,77 @@ def fill_template(
     lex_div_dict: dict[str, dict[str, list]],
     lex_div_assignment: dict[str, int],
     stated_gender: str,
-    df_vocab: pd.DataFrame,
+    vocab_index: dict[str, dict],
     proper_names_only: bool,
-    df_names=pd.DataFrame,
-    df_other_names=pd.DataFrame
-) -> tuple[pd.Series, dict[str, str]]:
+    names_index: dict[str, dict],
+    compiled_template: Optional[dict[str, list]] = None
+) -> tuple[TemplateRow, dict[str, str]]:
     """
     Process all the text columns in a single template row to substitute the variables for the values given.
 
     Args:
-        template_row (pd.Series): The row from the category DataFrame that contains text to process.
+        template_row (TemplateRow): The template row that contains text to process.
         name1 (str): Value selected for the NAME1 variable.
         gs_name1: TODO
         gs_name2: TODO
         lex_div_dict (dict[str, dict[str, list]]): Lexical diversity, pre-processed from the original DataFrame column into a standard dictionary. 
         lex_div_assignment (dict[str, int]): The assignment of which words from the lexical diversity vocabulary should be used for the current texts.
         stated_gender (str): The pre-processed value from the stated gender column, if available.
-        df_vocab (pd.DataFrame): The DataFrame of vocabulary for this category.
+        vocab_index (dict[str, dict]): Index of the vocabulary for this category, as returned by `build_vocab_index`.
+        proper_names_only (bool): Whether the template uses proper names.
+        names_index (dict[str, dict]): Index of the proper names, as returned by `build_proper_names_index`.
+        compiled_template (Optional[dict[str, list]]): The text columns of the row compiled by `compile_template`. If not given, they are compiled on each call.
 
     Returns:
-        tuple[pd.Series, dict[str, str]]: A pd.Series like the original row but with the processed texts, and a dict that maps all variables that occur in the texts to the values that were used to substitute them.
+        tuple[TemplateRow, dict[str, str]]: A TemplateRow like the original row but with the processed texts, and a dict that maps all variables that occur in the texts to the values that were used to substitute them.
     """
 
-    # create a copy of the row where the text will be modified
-    new_row = template_row.copy()
-    
+    # initialize the dictionary with the processed text of each column, to create the new row at the end
+    filled_texts: dict[str, str] = {}
+
     # initialize the dictionary that maps all occurring variables to the values used to substitute them
     values_used: dict = {}
 
-    df_names = pd.concat([df_names,df_other_names],ignore_index=True)
+    if compiled_template is None:
+        compiled_template = compile_template(template_row)
 
     # iterate over all the columns that might have variables to fill
-    for curr_text_col in ["ambiguous_context", "disambiguating_context", "lexical_diversity", "question_negative_stereotype", "question_non_negative", "answer_negative", "answer_non_negative"]:
-        curr_text = template_row.get(curr_text_col, "")
-        assert isinstance(curr_text, str)
+    for curr_text_col, segments in compiled_template.items():
 
-        new_text: str = curr_text.strip()
-
-        # find all the variables that are used in the text
-        variables: list = re.findall(r"\{\{([^\}]+)\}\}", curr_text)
-
-        # iterate over variables and replace each one
-        for variable in variables:
-            if variable.startswith("NAME1") or variable.startswith("NAME2"):
-
-                selected_name: str = name1 if variable.startswith("NAME1") else name2
-
-                # variable will be replaced by the selected NAME1 or NAME2...(*)
-                subst: str = selected_name
-
-                # for CaBBQ, proper names need to be always preceded by the def article
-                if language == "ca" and proper_names_only:
-                    names_row = df_names[df_names.proper_name == selected_name].iloc[0]
-                    subst = names_row.get("proper_name_def")
-
-                # switch to feminine version if the stated_gender is F and a feminine version is available
-                if selected_name in df_vocab.name.tolist() and stated_gender == "f":
-                    vocab_row = df_vocab[df_vocab.name == selected_name].iloc[0]
-                    subst = vocab_row.get("f") if vocab_row.get("f") else selected_name
-
-                # (*)...unless there is a specifier, in which case it needs to be replaced by its corresponding -def or -indef
-                if "-" in variable:
-                    label, specifier = variable.split("-")
-
-                    # exceptionally, for CaBBQ, vocabulary for Occupation subcat. in SES needs -def specifier to avoid ling. errors
-                    if language == "ca" and new_row.esbbq_category == "SES" and new_row.subcategory == "Occupation":
-                        selected_name: str = name1 if variable.startswith("NAME1") else name2
-                        vocab_row = df_vocab[df_vocab.name == selected_name].iloc[0]
-                        # get feminine def version
-                        if stated_gender == "f":
-                            subst = vocab_row.get("f_def")
-                        # get masc def version
-                        else:
-                            subst = vocab_row.get("name_def")
-                    
-                    # for all other cases:
-                    else: 
-                        assert names_dict, f"Variables with specifiers like '{variable}' can only be used with Names but the names column is empty."
-                        selected_name_idx: int = names_dict[label][None].index(selected_name)
-                        desired_group: list = names_dict[label][specifier]
-                        subst = desired_group[selected_name_idx]
-
-
-            elif variable.startswith("WORD"):
-                assert lex_div_dict and lex_div_assignment is not None, f"Text contains '{variable}' but no lexical diversity was found."
-
-                if "-" in variable:
-                    label, specifier = variable.split("-")
-                else:
-                    label, specifier = variable, None
+        # copy the segments of the compiled text, where the slots (in odd positions) will be replaced by their substitutions
+        filled_segments: list = segments.copy()
 
-                curr_word_idx: int = lex_div_assignment[label]
-                desired_group: list = lex_div_dict[label][specifier]
-                subst: str = desired_group[curr_word_idx]
+        # iterate over the slots of the text and fill each one
+        for slot_idx in range(1, len(segments), 2):
+            variable, label, specifier = segments[slot_idx]
 
-            # TODO[intersectionals -: this is untested and hasn't been used yet
-            # elif variable in ["GEN1", "GEN2", "OCC1", "OCC2"]:
-            #     assert (variable.endswith("1") and gs_name1 is not None) or (variable.endswith("2") and gs_name2 is not None)
-            #     subst = gs_name1 if variable.endswith("1") else gs_name2
+            # each variable only needs to be resolved once, even if it occurs several times or in several columns
+            if variable in values_used:
+                filled_segments[slot_idx] = values_used[variable]
+                continue
 
-            else:
-                raise Exception(f"Unrecognized variable in template with template_id={template_row.esbbq_template_id} column '{curr_text_col}': '{variable}'")
+            subst = resolve_variable(language, template_row, variable, label, specifier, name1, name2, names_dict, lex_div_dict, lex_div_assignment, stated_gender, vocab_index, proper_names_only, names_index)
 
-            # once the substitution is defined, replace the variable with the substitution in the text
-            new_text = new_text.replace("{{" + variable + "}}", subst).strip()
+            # once the substitution is defined, put it in the slot
+            filled_segments[slot_idx] = subst
 
             # store the value that was used
             values_used[variable] = subst
 
+        # join the literal segments and the substitutions into the new text
+        new_text: str = "".join(filled_segments).strip()
+
         # fix capitalization
         new_text = capitalize_sents(new_text)
 
         # fix linguistic errors
-        for error, replacement in ling_replacements[language]:
-            new_text = re.sub(error, replacement, new_text)
+        new_text = get_ling_rewriter(language)(new_text)
+
+        # save the new text for the new row's corresponding column
+        filled_texts[curr_text_col] = new_text
 
-        # replace the text with the new one in the new row's corresponding column
-        new_row[curr_text_col] = new_text
+    # create a copy of the row with the new texts
+    new_row = replace(template_row, **filled_texts)
 
     return new_row, values_used
 
@@ -183,55 +392,56 @@ def word_in_str(word, _str):
 
 def generate_instances(
     language: str,
-    row: pd.Series,
+    row: TemplateRow,
     bias_targets: list[str],
     values_used: dict[str, str],
     name1_info: str,
     name2_info: str,
     proper_names_only: bool
-) -> tuple[dict]:
+) -> Iterator[dict]:
     """
     Takes in the pre-processed template row and generates all four possible instances that use this template, by crossing ambiguous and disambiguating contexts and negative and non-negative questions.
+    The instances are yielded one at a time so that they can be streamed through the rest of the generation.
 
     Args:
-        row (pd.Series): The template row, with the texts already filled.
+        row (TemplateRow): The template row, with the texts already filled.
         bias_targets (list[str]): The list of bias targets, i.e. stereotyped groups.
         values_used (dict[str, str]): Mapping of all variables in the template to the values that were used to substitute them.
         name1_info (str): Information string referring to NAME1.
         name2_info (str): Information string referring to NAME2.
         stated_gender (str): The pre-processed stated gender info column from the template.
 
-    Returns:
-        tuple[dict]: A tuple of four dictionaries corresponding to the four instances.
+    Yields:
+        dict: Each of the four dictionaries corresponding to the four instances.
     """
 
     # save basic information that will be present in all the instances
-    template_id = row.get("esbbq_template_id")
-    template_label = row.get("label")
-    category = row.get("esbbq_category")
-    subcategory = row.get("subcategory", "")
-    stated_gender_info = row.get("stated_gender_info", "")
-    version = row.get("version", "None")
-    source = row.get("esbbq_source", "")
+    template_id = row.esbbq_template_id
+    template_label = row.label
+    category = row.esbbq_category
+    subcategory = row.subcategory
+    stated_gender_info = row.stated_gender_info
+    version = row.version
+    source = row.esbbq_source
     source = parse_list_from_string(source)
 
     # contexts
-    text_ambig = row.get("ambiguous_context")
-    text_disambig = row.get("disambiguating_context")
+    text_ambig = row.ambiguous_context
+    text_disambig = row.disambiguating_context
 
     # questions
-    q_neg = row.get("question_negative_stereotype")
-    q_non_neg = row.get("question_non_negative")
+    q_neg = row.question_negative_stereotype
+    q_non_neg = row.question_non_negative
 
     # answers
-    ans_neg = row.get("answer_negative")
-    ans_non_neg = row.get("answer_non_negative")
+    ans_neg = row.answer_negative
+    ans_non_neg = row.answer_non_negative
 
     # flipped
-    flipped = row.get("flipped")
+    flipped = row.flipped
 
     # stereotype
-    social_value = row.get("relevant_social_values")
+    social_value = row.relevant_social_values
 
     """
     NOTE: We have kept this format for compatibility with other BBQ versions but we don't shuffle the answers and we always put the unknown answer as "unknown" in ans2 because it will be handled at evaluation time.
@@ -377,7 +587,7 @@ def generate_instances(
         "label": ans_non_neg_pos, # q_non_neg -> ans_non_neg
     }
 
-    return (neg_ambig_instance, neg_disambig_instance, non_neg_ambig_instance, non_neg_disambig_instance)
+    yield from (neg_ambig_instance, neg_disambig_instance, non_neg_ambig_instance, non_neg_disambig_instance)
 
 def parse_list_from_string(_string: str) -> list[str]:
     """
@@ -419,40 +629,80 @@ def flip_names(text: str) -> str:
     flipped_text = text.replace("NAME1", "TMP").replace("NAME2", "NAME1").replace("TMP", "NAME2")
     return flipped_text
 
-def get_all_permutations(df: pd.DataFrame) -> pd.DataFrame:
+# columns where NAME1 and NAME2 are flipped in each of the permutations of a row
+flipped_columns = {
+    # Flip = None
+    "original": [],
+    # Flip NAME1/NAME2 only in ambiguous context
+    "ambig": ["ambiguous_context"],
+    # Flip NAME1/NAME2 in disambiguating context and answers
+    "disambig": ["disambiguating_context", "answer_negative", "answer_non_negative"],
+    # Flip NAME1/NAME2 in all columns
+    "all": ["ambiguous_context", "disambiguating_context", "answer_negative", "answer_non_negative"],
+}
+
+def get_all_permutations(template_rows: list[tuple[int, TemplateRow]]) -> tuple[list[tuple[int, TemplateRow]], Counter]:
     """
     Generates all possible permutations (4) of each row by flipping NAME1 and NAME2.
+    Instances are deduplicated by template ID, context and question, and questions are never flipped, so a permutation whose contexts are identical to those of a previous permutation of the same row (e.g. flipping a context without NAME variables) would only generate duplicates. Those permutations are detected in the templates, before filling them, and skipped.
+
+    Args:
+        template_rows (list[tuple[int, TemplateRow]]): The template rows, each with the index of the original row in the spreadsheet.
+
+    Returns:
+        tuple[list[tuple[int, TemplateRow]], Counter]: The distinct permutations of all the rows (with the index of the row they come from), and the number of permutations of each row skipped because they were equivalent to a previous one.
     """
     permuted_rows = []
-    
-    for _, row in df.iterrows():
-        # Flip = None
-        row['flipped'] = "original"
-        permuted_rows.append(row)
-
-        # Flip NAME1/NAME2 only in ambiguous context
-        flipped_row_amb = row.copy()
-        flipped_row_amb["ambiguous_context"] = flip_names(row["ambiguous_context"])
-        flipped_row_amb['flipped'] = "ambig"
-        permuted_rows.append(flipped_row_amb)
-
-        # Flip NAME1/NAME2 in disambiguating context and answers
-        flipped_row_disambig = row.copy()
-        for col in ["disambiguating_context","answer_negative","answer_non_negative"]:
-            flipped_row_disambig[col] = flip_names(row[col])
-            flipped_row_disambig['flipped'] = "disambig"
-        permuted_rows.append(flipped_row_disambig)
-
-        # Flip NAME1/NAME2 in all columns
-        flipped_row_all = row.copy()
-        for col in ["ambiguous_context","disambiguating_context","answer_negative","answer_non_negative"]:
-            flipped_row_all[col] = flip_names(row[col])
-            flipped_row_all['flipped'] = "all"
-        permuted_rows.append(flipped_row_all)
-
-    # Create a new DataFrame with all permutations
-    permuted_df = pd.DataFrame(permuted_rows)
-    return permuted_df
+    skipped_permutations = Counter()
+
+    for row_idx, row in template_rows:
+        # contexts of the permutations of this row that have been kept so far
+        seen_contexts = set()
+
+        for flipped, columns in flipped_columns.items():
+            permuted_row = replace(row, flipped=flipped, **{col: flip_names(getattr(row, col)) for col in columns})
+
+            contexts = (permuted_row.ambiguous_context, permuted_row.disambiguating_context)
+            if contexts in seen_contexts:
+                skipped_permutations[row_idx] += 1
+                continue
+
+            seen_contexts.add(contexts)
+            permuted_rows.append((row_idx, permuted_row))
+
+    return permuted_rows, skipped_permutations
+
+def get_aligned_permutations(aligned_rows: list[tuple[int, dict[str, TemplateRow]]]) -> tuple[list[tuple[int, dict[str, TemplateRow]]], Counter]:
+    """
+    Generates the permutations of each row in several languages at the same time, like `get_all_permutations`, so that the rows of all the languages have the same permutations.
+    Instances generated along with other languages are deduplicated in all of them as soon as they are duplicates in any language, so a permutation is skipped if its contexts are identical to those of a previous permutation of the same row in any language.
+
+    Args:
+        aligned_rows (list[tuple[int, dict[str, TemplateRow]]]): The template rows in each language, each with the index of the original row in the spreadsheet.
+
+    Returns:
+        tuple[list[tuple[int, dict[str, TemplateRow]]], Counter]: The distinct permutations of all the rows in each language (with the index of the row they come from), and the number of permutations of each row skipped because they were equivalent to a previous one.
+    """
+    permuted_rows = []
+    skipped_permutations = Counter()
+
+    for row_idx, rows in aligned_rows:
+        # contexts of the permutations of this row that have been kept so far, in each language
+        seen_contexts = {lang: set() for lang in rows}
+
+        for flipped, columns in flipped_columns.items():
+            permuted = {lang: replace(row, flipped=flipped, **{col: flip_names(getattr(row, col)) for col in columns}) for lang, row in rows.items()}
+
+            contexts = {lang: (permuted_row.ambiguous_context, permuted_row.disambiguating_context) for lang, permuted_row in permuted.items()}
+            if any(contexts[lang] in seen_contexts[lang] for lang in rows):
+                skipped_permutations[row_idx] += 1
+                continue
+
+            for lang in rows:
+                seen_contexts[lang].add(contexts[lang])
+            permuted_rows.append((row_idx, permuted))
+
+    return permuted_rows, skipped_permutations
 
 def group_by_specifiers(original_dict: dict) -> dict:
     """
@@ -478,11 +728,36 @@ def group_by_specifiers(original_dict: dict) -> dict:
 
     return expanded_dict
 
+# maximum number of texts whose capitalization is memoized by `capitalize_sents`
+capitalize_sents_cache_size = 2**16
+
+# characters that can end a sentence for the Punkt sentence tokenizer
+sent_end_chars = (".", "?", "!")
+
+@lru_cache(maxsize=None)
+def get_sent_tokenizer(language: str = "spanish") -> PunktTokenizer:
+    """
+    Loads the NLTK Punkt sentence tokenizer for the given language only once per process.
+    """
+    from nltk.tokenize import PunktTokenizer
+
+    return PunktTokenizer(language)
+
+@lru_cache(maxsize=capitalize_sents_cache_size)
 def capitalize_sents(text: str) -> str:
     """
     Capitalizes the first letter of each sentence after splitting the text into sentences with the NLTK sentence tokenizer.
+    The results are memoized, because the same filled texts come up again and again for different combinations of the same template (see `capitalize_sents.cache_info()` for the hits and misses).
     """
-    sents = sent_tokenize(text, language="spanish")
+    if not text:
+        return text
+
+    if any(char in text[:-1] for char in sent_end_chars):
+        sents = get_sent_tokenizer("spanish").tokenize(text)
+    else:
+        # fast path: if no sentence can end before the last character, the whole text is a single sentence
+        sents = [text]
+
     new_sents = []
 
     for sent in sents:
@@ -496,18 +771,53 @@ def capitalize_sents(text: str) -> str:
 
     return " ".join(new_sents)
 
-def get_lex_div_combinations(grouped_dict: dict) -> list[dict[str, int]]:
+class LexDivCombinations:
+    """
+    The combinations of the options of each WORD label of a template row, as a lazy sequence of dicts with the option index of each label (e.g. {"WORD1": 0, "WORD2": 2}).
+    Combinations are created only when they are used, in the order of `itertools.product` (the last label changes fastest), so they are never all in memory at once. The sequence can be iterated as many times as needed, and supports `len` and indexing.
+    If there are more than `max_combinations`, only the first `max_combinations` are kept (see `truncated`).
     """
-    TODO[docs]
+
+    def __init__(self, lengths: dict[str, int], max_combinations: Optional[int] = None):
+        self.lengths = lengths
+        self.num_combinations = math.prod(lengths.values())
+        self.truncated = max_combinations is not None and self.num_combinations > max_combinations
+        self.size = max_combinations if self.truncated else self.num_combinations
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[dict[str, int]]:
+        labels = list(self.lengths)
+        for selection in itertools.islice(itertools.product(*[range(length) for length in self.lengths.values()]), self.size):
+            yield dict(zip(labels, selection))
+
+    def __getitem__(self, idx: int) -> dict[str, int]:
+        if idx < 0:
+            idx += self.size
+        if not 0 <= idx < self.size:
+            raise IndexError("Lexical diversity combination index out of range.")
+
+        # decode the index as a mixed-radix number, with one digit per label (the last label is the least significant)
+        selection = {}
+        for label, length in reversed(self.lengths.items()):
+            idx, selection[label] = divmod(idx, length)
+        return {label: selection[label] for label in self.lengths}
+
+def get_lex_div_combinations(grouped_dict: dict, max_combinations: Optional[int] = None) -> LexDivCombinations:
     """
+    Returns all the combinations of the options of WORD1, WORD2, ..., WORD<N> in the lexical diversity of a template row (see `LexDivCombinations`).
 
-    labels = list(grouped_dict.keys())
-    lengths = [len(grouped_dict[label][list(grouped_dict[label].keys())[0]]) for label in labels]
+    Args:
+        grouped_dict (dict): The lexical diversity of the row, grouped by label and specifier (see `group_by_specifiers`).
+        max_combinations (Optional[int]): Maximum number of combinations to keep, if any.
 
-    index_product = list(itertools.product(*[range(length) for length in lengths]))
+    Returns:
+        LexDivCombinations: The combinations, with the option index of each label.
+    """
 
-    selections = [{label : idx for label, idx in zip(labels, selection)} for selection in index_product]
-    return selections
+    lengths = {label: len(grouped_dict[label][list(grouped_dict[label].keys())[0]]) for label in grouped_dict}
+    return LexDivCombinations(lengths, max_combinations)
 
 def flatten_nested_dicts(original_dict: dict) -> dict:
     """